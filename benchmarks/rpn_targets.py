@@ -0,0 +1,79 @@
+# Parity check and benchmark of siamese_utils.build_rpn_targets against
+# modellib.build_rpn_targets on random ground truth boxes.
+# Run from the repository root: python benchmarks/rpn_targets.py
+
+import sys
+import time
+import argparse
+import numpy as np
+
+MASK_RCNN_MODEL_PATH = 'lib/Mask_RCNN/'
+
+if MASK_RCNN_MODEL_PATH not in sys.path:
+    sys.path.append(MASK_RCNN_MODEL_PATH)
+if '.' not in sys.path:
+    sys.path.append('.')
+
+from mrcnn import model as modellib
+from lib import utils as siamese_utils
+from lib import config as siamese_config
+
+
+class BenchmarkConfig(siamese_config.Config):
+    NAME = 'benchmark'
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+
+
+def random_gt(random_state, image_shape, max_instances=20, crowd_fraction=0.1):
+    """Returns random gt_class_ids (negative for crowds) and gt_boxes."""
+    n = random_state.randint(1, max_instances)
+    h, w = image_shape[:2]
+    y1 = random_state.randint(0, h - 64, n)
+    x1 = random_state.randint(0, w - 64, n)
+    y2 = np.minimum(y1 + random_state.randint(5, 200, n), h)
+    x2 = np.minimum(x1 + random_state.randint(5, 200, n), w)
+    class_ids = np.where(random_state.rand(n) < crowd_fraction, -1, 1).astype(np.int32)
+    # At least one instance that is not a crowd
+    class_ids[0] = 1
+    return class_ids, np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+
+
+def main(samples=200, seed=0):
+    config = BenchmarkConfig()
+    image_shape = config.IMAGE_SHAPE
+    anchors = siamese_utils.get_anchors(config, image_shape)
+    geometry = siamese_utils.get_anchor_geometry(config)
+    random_state = np.random.RandomState(seed)
+    gt = [random_gt(random_state, image_shape) for _ in range(samples)]
+    print("{} anchors, {} samples".format(anchors.shape[0], samples))
+
+    # Parity: same targets for the same random state
+    for i, (class_ids, boxes) in enumerate(gt):
+        np.random.seed(i)
+        match, bbox = modellib.build_rpn_targets(image_shape, anchors, class_ids, boxes, config)
+        np.random.seed(i)
+        new_match, new_bbox = siamese_utils.build_rpn_targets(geometry, class_ids, boxes, config)
+        assert np.array_equal(match, new_match), "rpn_match differs for sample {}".format(i)
+        assert np.allclose(bbox, new_bbox, atol=1e-6), "rpn_bbox differs for sample {}".format(i)
+    print("Targets are identical")
+
+    # Benchmark
+    t = time.time()
+    for class_ids, boxes in gt:
+        modellib.build_rpn_targets(image_shape, anchors, class_ids, boxes, config)
+    t_old = (time.time() - t) / samples
+    t = time.time()
+    for class_ids, boxes in gt:
+        siamese_utils.build_rpn_targets(geometry, class_ids, boxes, config)
+    t_new = (time.time() - t) / samples
+    print("modellib.build_rpn_targets:      {:.2f} ms/sample".format(1000 * t_old))
+    print("siamese_utils.build_rpn_targets: {:.2f} ms/sample ({:.1f}x)".format(1000 * t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parity check and benchmark of the RPN target building')
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(samples=args.samples, seed=args.seed)
@@ -0,0 +1,95 @@
+# Parity check and benchmark of siamese_model.target_embedding_graph (pool
+# every target pyramid, then average over the targets) against the previous
+# target branch (average the target pyramids, then pool) on random targets.
+# Both branches share the same randomly initialized resnet and fpn models.
+# Run from the repository root: python benchmarks/target_embedding.py
+
+import sys
+import time
+import argparse
+import numpy as np
+
+MASK_RCNN_MODEL_PATH = 'lib/Mask_RCNN/'
+
+if MASK_RCNN_MODEL_PATH not in sys.path:
+    sys.path.append(MASK_RCNN_MODEL_PATH)
+if '.' not in sys.path:
+    sys.path.append('.')
+
+import tensorflow as tf
+import keras.backend as K
+import keras.layers as KL
+import keras.models as KM
+
+from lib import model as siamese_model
+from lib import config as siamese_config
+
+
+class BenchmarkConfig(siamese_config.Config):
+    NAME = 'benchmark'
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+
+
+def previous_target_embedding_graph(target, resnet, fpn, config):
+    """The target branch before pooling per target: the folded target pyramids
+    are unfolded and averaged at full resolution, then every level is pooled."""
+    folded_target = KL.Lambda(lambda x: K.reshape(x, [-1] + config.TARGET_SHAPE.tolist()),
+                              name="fold_targets")(target)
+    _, TC2, TC3, TC4, TC5 = resnet(folded_target)
+    target_pyramid = fpn([TC2, TC3, TC4, TC5])
+    TP = [KL.Lambda(lambda x: previous_unfold_targets_mean_graph(*x),
+                    name="target_mean_P{}".format(i + 2))([T, target])
+          for i, T in enumerate(target_pyramid)]
+    TE = [KL.GlobalAveragePooling2D()(T) for T in TP]
+    return KL.Lambda(lambda x: K.stack(x, axis=1), name="target_embedding")(TE)
+
+
+def previous_unfold_targets_mean_graph(x, target):
+    shape = tf.shape(x)
+    target_shape = tf.shape(target)
+    x = tf.reshape(x, [target_shape[0], target_shape[1], shape[1], shape[2], int(x.shape[-1])])
+    return tf.reduce_mean(x, axis=1)
+
+
+def main(batch_size=2, num_targets=5, runs=20, seed=0):
+    config = BenchmarkConfig()
+    resnet = siamese_model.build_resnet_model(config)
+    fpn = siamese_model.build_fpn_model(feature_maps=config.FPN_FEATUREMAPS)
+    input_target = KL.Input(shape=[None] + config.TARGET_SHAPE.tolist(), name="input_target")
+    previous = KM.Model([input_target], [previous_target_embedding_graph(input_target, resnet, fpn, config)])
+    current = KM.Model([input_target], [siamese_model.target_embedding_graph(input_target, resnet, fpn, config)])
+
+    targets = np.random.RandomState(seed).uniform(-120, 120,
+        [batch_size, num_targets] + config.TARGET_SHAPE.tolist()).astype(np.float32)
+    print("{} images with {} targets of shape {}".format(batch_size, num_targets, tuple(config.TARGET_SHAPE)))
+
+    # Parity: same embeddings for the same targets and weights
+    previous_embedding = previous.predict(targets)
+    current_embedding = current.predict(targets)
+    assert previous_embedding.shape == current_embedding.shape
+    assert np.allclose(previous_embedding, current_embedding, rtol=1e-4, atol=1e-5 * np.abs(previous_embedding).max()), \
+        "target embeddings differ by up to {}".format(np.abs(previous_embedding - current_embedding).max())
+    print("Embeddings are identical up to float rounding (max difference {:.2e}, max value {:.2e})".format(
+        np.abs(previous_embedding - current_embedding).max(), np.abs(previous_embedding).max()))
+
+    # Benchmark
+    timings = []
+    for model in [previous, current]:
+        t = time.time()
+        for _ in range(runs):
+            model.predict(targets)
+        timings.append((time.time() - t) / runs)
+    t_previous, t_current = timings
+    print("mean pyramid, then pool:      {:.1f} ms/batch".format(1000 * t_previous))
+    print("pool per target, then mean:   {:.1f} ms/batch ({:.2f}x)".format(1000 * t_current, t_previous / t_current))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parity check and benchmark of the target embedding branch')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--targets', type=int, default=5)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(batch_size=args.batch_size, num_targets=args.targets, runs=args.runs, seed=args.seed)
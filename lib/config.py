@@ -158,6 +158,12 @@ class Config(MRCNNConfig):
 
     # Image mean (RGB)
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
+    
+    # CHANGE: Added UINT8_INPUT
+    # If True, input_image and input_target take uint8 pixels and the mean
+    # pixel is subtracted as the first op of the graph. Data generators and
+    # detect() then skip molding on the CPU and ship 4x smaller batches.
+    UINT8_INPUT = False
 
     # Number of ROIs per image to feed to classifier/mask heads
     # The Mask RCNN paper uses 512 but often the RPN doesn't generate
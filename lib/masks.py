@@ -0,0 +1,140 @@
+# Siamese Mask R-CNN Masks
+# Box-local instance masks, shared by lib.utils and lib.serving. Only depends
+# on numpy and pycocotools, so serving doesn't need Keras for them.
+
+import operator
+import numpy as np
+
+from pycocotools import mask as maskUtils
+
+
+def bilinear_resize_weights(in_size, out_size):
+    """Returns the [out_size, in_size] matrix that resizes a signal bilinearly
+    like skimage.transform.resize(order=1, mode="constant") with zero padding.
+    out_size: Output size or list of output sizes. For a list the matrices of 
+        all sizes are stacked to [sum(out_size), in_size].
+    """
+    sizes = np.atleast_1d(np.asarray(out_size, dtype=np.int64))
+    total = int(np.sum(sizes))
+    # Position of every output row within its own output signal
+    starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    scales = np.repeat(in_size / np.maximum(sizes, 1), sizes)
+    x = (np.arange(total) - starts + 0.5) * scales - 0.5
+    x0 = np.floor(x).astype(np.int32)
+    w = x - x0
+    # Shift indices by one so the zero padding at -1 and in_size fits
+    weights = np.zeros([total, in_size + 2], dtype=np.float32)
+    rows = np.arange(total)
+    np.add.at(weights, (rows, x0 + 1), 1 - w)
+    np.add.at(weights, (rows, x0 + 2), w)
+    return weights[:, 1:-1]
+
+
+class CropMasks(object):
+    """Instance masks of one image stored as box-local bitmaps instead of
+    full size masks. Behaves like the [height, width, N] bool array it 
+    represents (shape, astype, indexing, comparisons, np.asarray), which is 
+    only materialized on request. Indexing materializes only the selected 
+    masks, comparisons with scalars stay box-local where possible.
+    boxes: [N, (y1, x1, y2, x2)] in image pixels
+    crops: List of N bool arrays [y2 - y1, x2 - x1]
+    image_shape: (height, width) of the image
+    """
+    dtype = np.dtype(np.bool)
+    
+    def __init__(self, boxes, crops, image_shape):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape([-1, 4])
+        self.crops = list(crops)
+        self.image_shape = tuple(int(x) for x in image_shape[:2])
+        
+    @property
+    def shape(self):
+        return self.image_shape + (len(self.crops),)
+    
+    @classmethod
+    def unmold(cls, masks, boxes, image_shape, threshold=0.5):
+        """Resizes the small float masks of the network to their boxes.
+        masks: [N, height, width] e.g. 28x28 float masks
+        boxes: [N, (y1, x1, y2, x2)] in image pixels
+        """
+        boxes = np.asarray(boxes, dtype=np.int32).reshape([-1, 4])
+        masks = np.asarray(masks, dtype=np.float32)
+        heights = boxes[:, 2] - boxes[:, 0]
+        widths = boxes[:, 3] - boxes[:, 1]
+        # Resize weights of all boxes at once, split per box
+        row_weights = np.split(bilinear_resize_weights(masks.shape[1], heights), np.cumsum(heights)[:-1])
+        col_weights = np.split(bilinear_resize_weights(masks.shape[2], widths), np.cumsum(widths)[:-1])
+        crops = [rows.dot(mask).dot(cols.T) >= threshold 
+                 for mask, rows, cols in zip(masks, row_weights, col_weights)]
+        return cls(boxes, crops, image_shape)
+    
+    @classmethod
+    def concatenate(cls, masks_list):
+        """Concatenates CropMasks of the same image along the instance axis.
+        Full size masks (e.g. of lib.serving) are concatenated as arrays."""
+        if not all(isinstance(m, cls) for m in masks_list):
+            return np.concatenate([np.asarray(m) for m in masks_list], axis=-1)
+        image_shape = masks_list[0].image_shape
+        return cls(np.concatenate([m.boxes for m in masks_list]),
+                   [crop for m in masks_list for crop in m.crops], image_shape)
+    
+    def full(self, dtype=np.bool, order='C'):
+        """Returns the full size masks [height, width, N]."""
+        masks = np.zeros(self.shape, dtype=dtype, order=order)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            masks[y1:y2, x1:x2, i] = self.crops[i]
+        return masks
+    
+    def __array__(self, dtype=None):
+        return self.full(dtype or np.bool)
+    
+    def astype(self, dtype):
+        return self.full(dtype)
+    
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        if len(key) != 3:
+            raise IndexError("too many indices for CropMasks of shape {}".format(self.shape))
+        # Materialize the selected masks only and index them instead
+        channels = np.arange(len(self.crops))[key[2]]
+        if isinstance(key[2], slice):
+            selected, index = channels, slice(None)
+        else:
+            selected, index = np.unique(channels, return_inverse=True)
+            index = int(index[0]) if np.ndim(channels) == 0 else index.reshape(np.shape(channels))
+        masks = CropMasks(self.boxes[selected], [self.crops[i] for i in selected], self.image_shape).full()
+        return masks[key[0], key[1], index]
+    
+    def _compare(self, op, other):
+        # Pixels outside the boxes are False, stay box-local if they compare False
+        if np.isscalar(other) and not op(False, other):
+            return CropMasks(self.boxes, [op(crop, other) for crop in self.crops], self.image_shape)
+        return op(self.full(), other)
+    
+    def __gt__(self, other):
+        return self._compare(operator.gt, other)
+    
+    def __ge__(self, other):
+        return self._compare(operator.ge, other)
+    
+    def __lt__(self, other):
+        return self._compare(operator.lt, other)
+    
+    def __le__(self, other):
+        return self._compare(operator.le, other)
+    
+    def __eq__(self, other):
+        return self._compare(operator.eq, other)
+    
+    def __ne__(self, other):
+        return self._compare(operator.ne, other)
+    
+    __hash__ = None
+    
+    def encode(self):
+        """Returns the COCO RLEs of all masks, encoded in one call."""
+        return maskUtils.encode(self.full(np.uint8, order='F'))
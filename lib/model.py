@@ -7,6 +7,7 @@ import os
 import re
 import time
 import random
+import json
 import numpy as np
 import skimage.io
 import imgaug
@@ -80,16 +81,93 @@ def fpn_graph(C2, C3, C4, C5, feature_maps=128):
     return [P2, P3, P4, P5, P6]
 
 
+def target_embedding_graph(target, resnet, fpn, config):
+    """Runs the shared resnet and fpn models on every target, pools every 
+    pyramid level to one vector and averages the vectors over the targets.
+    CHANGE: The target axis is folded into the batch axis, so the backbone 
+    runs once on [batch * NUM_TARGETS, height, width, 3] and the graph has the 
+    same size for any number of targets.
+    CHANGE: Levels are pooled per target before the mean over the targets, 
+    which is the same as pooling the mean pyramid but never unfolds the full 
+    resolution target pyramids.
+    target: [batch, NUM_TARGETS, height, width, 3] molded targets. 
+        NUM_TARGETS may be None (e.g. in the inference target encoder).
+    Returns [batch, 5 pyramid levels, FPN_FEATUREMAPS]
+    """
+    folded_target = KL.Lambda(lambda x: K.reshape(x, [-1] + config.TARGET_SHAPE.tolist()), 
+                              name="fold_targets")(target)
+    _, TC2, TC3, TC4, TC5 = resnet(folded_target)
+    target_pyramid = fpn([TC2, TC3, TC4, TC5])
+    TE = [KL.GlobalAveragePooling2D()(T) for T in target_pyramid]
+    TE = KL.Lambda(lambda x: K.stack(x, axis=1), name="target_level_embedding")(TE)
+    return KL.Lambda(lambda x: unfold_targets_mean_graph(*x), name="target_embedding")([TE, target])
+
+
+def unfold_targets_mean_graph(x, target):
+    """Inverse of the target folding in target_embedding_graph, averaged.
+    x: [batch * NUM_TARGETS, levels, channels] pooled target pyramids
+    target: [batch, NUM_TARGETS, ...] the unfolded input, for its shape
+    Returns [batch, levels, channels] mean over the targets
+    """
+    target_shape = tf.shape(target)
+    x = tf.reshape(x, [target_shape[0], target_shape[1], int(x.shape[1]), int(x.shape[2])])
+    return tf.reduce_mean(x, axis=1)
+
+
+class L1DistanceConv(KE.Layer):
+    """Fused siamese distance and 1x1 conv of l1_distance_graph. The conv of 
+    the concatenation [P, |P - T|] is computed as P * W_P + |P - T| * W_L + b 
+    with the two halves of the kernel, so the concatenated tensor with twice 
+    the channels of P is never built. The weights have the names and shapes 
+    of the Conv2D it replaces, so existing checkpoints load into it.
+
+    Inputs:
+        P: [batch, height, width, channels] image feature map
+        T: [batch, channels] pooled target embedding of the level
+
+    Returns:
+        [batch, height, width, filters]
+    """
+
+    def __init__(self, filters, **kwargs):
+        super(L1DistanceConv, self).__init__(**kwargs)
+        self.filters = filters
+
+    def build(self, input_shape):
+        channels = int(input_shape[0][-1])
+        self.kernel = self.add_weight(name="kernel", shape=(1, 1, 2 * channels, self.filters),
+                                      initializer="glorot_uniform")
+        self.bias = self.add_weight(name="bias", shape=(self.filters,), initializer="zeros")
+        super(L1DistanceConv, self).build(input_shape)
+
+    def call(self, inputs):
+        P, T = inputs
+        channels = int(P.shape[-1])
+        T = tf.expand_dims(tf.expand_dims(T, 1), 1)
+        D = K.conv2d(P, self.kernel[:, :, :channels]) +\
+            K.conv2d(tf.abs(P - T), self.kernel[:, :, channels:])
+        return K.bias_add(D, self.bias)
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[0][:-1]) + (self.filters,)
+
+    def get_config(self):
+        config = super(L1DistanceConv, self).get_config()
+        config["filters"] = self.filters
+        return config
+
+
 def l1_distance_graph(P, T, feature_maps=128, name='Tx'):
-    T = KL.GlobalAveragePooling2D()(T)
+    # CHANGE: T is the pooled target embedding [batch, channels] of the level,
+    # see target_embedding_graph
+    # CHANGE: The distance and the 1x1 conv are fused, see L1DistanceConv
+    if feature_maps:
+        return L1DistanceConv(feature_maps, name='fpn_distance_' + name)([P, T])
+    
     T = KL.Lambda(lambda x: K.expand_dims(K.expand_dims(x, axis=1), axis=1))(T)
-#     T = KL.Lambda(lambda x: K.tile(T, [1, int(P.shape[1]), int(P.shape[2]), 1]))(T)
     L1 = KL.Subtract()([P, T])
     L1 = KL.Lambda(lambda x: K.abs(x))(L1)
     D = KL.Concatenate()([P, L1])#KL.Concatenate()([P, T, L1])
-    if feature_maps:
-        D = KL.Conv2D(feature_maps, (1, 1), name='fpn_distance_' + name)(D)
-    
     return D
 
 def fpn_classifier_graph(rois, feature_maps, image_meta,
@@ -197,6 +275,12 @@ def fpn_mask_graph(rois, feature_maps, image_meta,
     x = KL.Concatenate(axis=-1)([x for i in range(num_classes)])
     return x
 
+def mold_image_graph(images, config):
+    """Graph version of modellib.mold_image. Casts uint8 images to float32 
+    and subtracts the mean pixel."""
+    return tf.cast(images, tf.float32) - np.array(config.MEAN_PIXEL, dtype=np.float32)
+
+
 def mrcnn_class_loss_graph(target_class_ids, pred_class_logits, active_class_ids):
     """Loss for the classifier head of Mask RCNN.
     target_class_ids: [batch, num_rois]. Integer class IDs. Uses zero
@@ -239,13 +323,18 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
 
         # Inputs
+        # CHANGE: optionally take uint8 pixels, see config.UINT8_INPUT
+        input_dtype = tf.uint8 if config.UINT8_INPUT else tf.float32
         input_image = KL.Input(
-            shape=config.IMAGE_SHAPE.tolist(), name="input_image")
+            shape=config.IMAGE_SHAPE.tolist(), name="input_image", dtype=input_dtype)
         # CHANGE: add target input
         if not config.NUM_TARGETS:
             config.NUM_TARGETS = 1
+        # CHANGE: The number of targets is only fixed for training, the 
+        # inference target encoder takes any number of targets per set
+        num_targets = config.NUM_TARGETS if mode == "training" else None
         input_target = KL.Input(
-            shape=[config.NUM_TARGETS] + config.TARGET_SHAPE.tolist(), name="input_target")
+            shape=[num_targets] + config.TARGET_SHAPE.tolist(), name="input_target", dtype=input_dtype)
         input_image_meta = KL.Input(shape=[config.IMAGE_META_SIZE],
                                     name="input_image_meta")
         if mode == "training":
@@ -286,27 +375,33 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
         # Create FPN Model
         resnet = build_resnet_model(self.config)
         fpn = build_fpn_model(feature_maps=self.config.FPN_FEATUREMAPS)
+        # CHANGE: Mold uint8 inputs in the graph
+        if config.UINT8_INPUT:
+            image = KL.Lambda(lambda x: mold_image_graph(x, config), name="mold_image")(input_image)
+            target = KL.Lambda(lambda x: mold_image_graph(x, config), name="mold_target")(input_target)
+        else:
+            image, target = input_image, input_target
         # Create Image FP
-        _, IC2, IC3, IC4, IC5 = resnet(input_image)
+        _, IC2, IC3, IC4, IC5 = resnet(image)
         IP2, IP3, IP4, IP5, IP6 = fpn([IC2, IC3, IC4, IC5])
         # Create Target FR
-        input_targets = [KL.Lambda(lambda x: x[:,idx,...])(input_target) for idx in range(input_target.shape[1])]
-        for k, one_target in enumerate(input_targets):
-            _, TC2, TC3, TC4, TC5 = resnet(one_target)
-            out = fpn([TC2, TC3, TC4, TC5])
-            if k == 0:
-                target_pyramid = out
-            else:
-                target_pyramid = [KL.Add(name="target_adding_{}_{}".format(k, i))(
-                    [target_pyramid[i], out[i]]) for i in range(len(out))]
-                
-        TP2, TP3, TP4, TP5, TP6 = [KL.Lambda(lambda x: x / config.NUM_TARGETS)(
-            target_pyramid[i]) for i in range(len(target_pyramid))]
-#        one_target = KL.Lambda(lambda x: x[:,0,...])(input_target)
-#        one_target = input_target[:,0,...]
-#         _, TC2, TC3, TC4, TC5 = resnet(one_target)
-#         TP2, TP3, TP4, TP5, TP6 = fpn([TC2, TC3, TC4, TC5])
-    
+        # CHANGE: In inference mode targets are encoded by a separate model
+        # that shares resnet and fpn, so detect() can reuse target embeddings
+        if mode == "training":
+            target_embedding = target_embedding_graph(target, resnet, fpn, config)
+        else:
+            self.target_encoder = KM.Model([input_target], [target_embedding_graph(target, resnet, fpn, config)],
+                                           name="target_encoder")
+            target_embedding = KL.Input(shape=[5, config.FPN_FEATUREMAPS], name="input_target_embedding")
+            input_target_embedding = target_embedding
+            # CHANGE: The detection heads become a separate model on the image
+            # pyramid, so one pyramid can be compared with many target embeddings
+            image_pyramid = [IP2, IP3, IP4, IP5, IP6]
+            self.image_encoder = KM.Model([input_image], image_pyramid, name="image_encoder")
+            input_image_pyramid = [KL.Input(shape=[None, None, config.FPN_FEATUREMAPS], name="input_image_P{}".format(i))
+                                   for i in range(2, 7)]
+            IP2, IP3, IP4, IP5, IP6 = input_image_pyramid
+        TP2, TP3, TP4, TP5, TP6 = [KL.Lambda(lambda x, i=i: x[:, i])(target_embedding) for i in range(5)]
         
         # CHANGE: add siamese distance copmputation
         # Combine FPs using L1 distance
@@ -324,11 +419,10 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
         # Anchors
         if mode == "training":
             anchors = self.get_anchors(config.IMAGE_SHAPE)
-            # Duplicate across the batch dimension because Keras requires it
-            # TODO: can this be optimized to avoid duplicating the anchors?
-            anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
-            # A hack to get around Keras's bad support for constants
-            anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
+            # CHANGE: Keep a single copy of the anchors as a constant and only
+            # broadcast it across the batch dimension in the graph
+            anchors = KL.Lambda(lambda x: tf.tile(tf.expand_dims(tf.constant(anchors), 0), 
+                                                  [tf.shape(x)[0], 1, 1]), name="anchors")(input_image)
         else:
             anchors = input_anchors
 
@@ -467,15 +561,23 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
                                                   num_classes=2,
                                                   train_bn=config.TRAIN_BN)
             
-            # CHANGE: Added target to the input
-            inputs = [input_image, input_image_meta, input_target, input_anchors]
+            # CHANGE: Heads take the image pyramid and the target embedding
+            inputs = input_image_pyramid + [input_image_meta, input_target_embedding, input_anchors]
             if config.MODEL == 'mrcnn':
                 outputs = [detections, mrcnn_class, mrcnn_bbox,
                            mrcnn_mask, rpn_rois, rpn_class, rpn_bbox]
             elif config.MODEL =='frcnn':
                 outputs = [detections, mrcnn_class, mrcnn_bbox,
                            rpn_rois, rpn_class, rpn_bbox]
-            model = KM.Model(inputs, outputs, name='mask_rcnn')
+            self.siamese_heads = KM.Model(inputs, outputs, name='siamese_heads')
+            
+            # CHANGE: Added target embedding to the input
+            model_inputs = [input_image,
+                            KL.Input(shape=[config.IMAGE_META_SIZE], name="input_image_meta"),
+                            KL.Input(shape=[5, config.FPN_FEATUREMAPS], name="input_target_embedding"),
+                            KL.Input(shape=[None, 4], name="input_anchors")]
+            outputs = self.siamese_heads(image_pyramid + model_inputs[1:])
+            model = KM.Model(model_inputs, outputs, name='mask_rcnn')
             
 
         # Add multi-GPU support.
@@ -486,6 +588,51 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
         return model
     
     
+    def load_weights(self, filepath, by_name=False, exclude=None):
+        """Loads weights, see MaskRCNN.load_weights.
+        CHANGE: In inference mode the detection heads are the nested 
+        siamese_heads model. Its layers are loaded like top level layers, so 
+        checkpoints of the flat training model load by name.
+        """
+        import h5py
+        from keras.engine import topology
+
+        if exclude:
+            by_name = True
+
+        if h5py is None:
+            raise ImportError('`load_weights` requires h5py.')
+        f = h5py.File(filepath, mode='r')
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+
+        # In multi-GPU training, we wrap the model. Get layers
+        # of the inner model because they have the weights.
+        keras_model = self.keras_model
+        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
+            else keras_model.layers
+        expanded_layers = []
+        for layer in layers:
+            if layer.name == 'siamese_heads':
+                expanded_layers.extend(layer.layers)
+            else:
+                expanded_layers.append(layer)
+        layers = expanded_layers
+
+        # Exclude some layers
+        if exclude:
+            layers = filter(lambda l: l.name not in exclude, layers)
+
+        if by_name:
+            topology.load_weights_from_hdf5_group_by_name(f, layers)
+        else:
+            topology.load_weights_from_hdf5_group(f, layers)
+        if hasattr(f, 'close'):
+            f.close()
+
+        # Update the log directory
+        self.set_log_dir(filepath)
+    
     def compile(self, learning_rate, momentum):
         """Gets the model ready for training. Adds losses, regularization, and
         metrics. Then calls the Keras compile() function.
@@ -665,12 +812,14 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
             layers = layer_regex[layers]
 
         # Data generators
-        # CHANGE: Use siamese data generator
-        train_generator = siamese_utils.siamese_data_generator(train_dataset, self.config, shuffle=True,
+        # CHANGE: Use siamese data sequences, safe with multiprocessing workers
+        train_generator = siamese_utils.SiameseDataSequence(train_dataset, self.config, shuffle=True,
                                          augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE)
-        val_generator = siamese_utils.siamese_data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+                                         batch_size=self.config.BATCH_SIZE,
+                                         steps=self.config.STEPS_PER_EPOCH)
+        val_generator = siamese_utils.SiameseDataSequence(val_dataset, self.config, shuffle=True,
+                                       batch_size=self.config.BATCH_SIZE,
+                                       steps=self.config.VALIDATION_STEPS)
 
         # Callbacks
         callbacks = [
@@ -693,30 +842,140 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
             workers = 0
         else:
             workers = multiprocessing.cpu_count()
-
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=True,
-        )
+            # Workers fill batches in a shared memory ring, Keras only consumes them.
+            # Two slots per worker keep all workers busy.
+            train_generator = siamese_utils.SiameseDataLoader(train_generator, workers=workers, 
+                                                              max_queue_size=2 * workers)
+            val_workers = max(1, workers // 4)
+            val_generator = siamese_utils.SiameseDataLoader(val_generator, workers=val_workers, 
+                                                            max_queue_size=2 * val_workers)
+
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=100,
+                workers=0,
+                use_multiprocessing=False,
+            )
+        finally:
+            if workers:
+                train_generator.close()
+                val_generator.close()
         self.epoch = max(self.epoch, epochs)
       
     
-    def detect(self, targets, images, verbose=0, random_detections=False, eps=1e-6):
+    def mold_inputs(self, images):
+        """Resizes images and builds their image metas, see MaskRCNN.mold_inputs.
+        CHANGE: With config.UINT8_INPUT the images are kept as uint8 pixels
+        because the graph molds them.
+        """
+        if not self.config.UINT8_INPUT:
+            return super(SiameseMaskRCNN, self).mold_inputs(images)
+        molded_images = []
+        image_metas = []
+        windows = []
+        for image in images:
+            # Resize image
+            molded_image, window, scale, padding, crop = utils.resize_image(
+                image,
+                min_dim=self.config.IMAGE_MIN_DIM,
+                min_scale=self.config.IMAGE_MIN_SCALE,
+                max_dim=self.config.IMAGE_MAX_DIM,
+                mode=self.config.IMAGE_RESIZE_MODE)
+            # Build image_meta
+            image_meta = modellib.compose_image_meta(
+                0, image.shape, molded_image.shape, window, scale,
+                np.zeros([self.config.NUM_CLASSES], dtype=np.int32))
+            # Append
+            molded_images.append(molded_image.astype(np.uint8))
+            windows.append(window)
+            image_metas.append(image_meta)
+        # Pack into arrays
+        molded_images = np.stack(molded_images)
+        image_metas = np.stack(image_metas)
+        windows = np.stack(windows)
+        return molded_images, image_metas, windows
+    
+    def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
+                          image_shape, window):
+        """Reformats the detections of one image, see MaskRCNN.unmold_detections.
+        CHANGE: masks are returned as siamese_utils.CropMasks, which keep each
+        mask only inside its box. All masks are resized with precomputed
+        bilinear weights instead of one skimage resize and full size mask each.
+        """
+        # How many detections do we have?
+        # Detections array is padded with zeros. Find the first class_id == 0.
+        zero_ix = np.where(detections[:, 4] == 0)[0]
+        N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+
+        # Extract boxes, class_ids, scores, and class-specific masks
+        boxes = detections[:N, :4]
+        class_ids = detections[:N, 4].astype(np.int32)
+        scores = detections[:N, 5]
+        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+
+        # Translate normalized coordinates in the resized image to pixel
+        # coordinates in the original image before resizing
+        window = utils.norm_boxes(window, image_shape[:2])
+        wy1, wx1, wy2, wx2 = window
+        shift = np.array([wy1, wx1, wy1, wx1])
+        wh = wy2 - wy1  # window height
+        ww = wx2 - wx1  # window width
+        scale = np.array([wh, ww, wh, ww])
+        # Convert boxes to normalized coordinates on the window
+        boxes = np.divide(boxes - shift, scale)
+        # Convert boxes to pixel coordinates on the original image
+        boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+
+        # Filter out detections with zero area. Happens in early training when
+        # network weights are still random
+        keep_ix = np.where(
+            (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) > 0)[0]
+        boxes = boxes[keep_ix]
+        class_ids = class_ids[keep_ix]
+        scores = scores[keep_ix]
+        masks = masks[keep_ix]
+
+        return boxes, class_ids, scores, siamese_utils.CropMasks.unmold(masks, boxes, original_image_shape)
+    
+    def encode_targets(self, targets, verbose=0):
+        """Encodes target sets to the pooled target pyramids the detection
+        heads compare images with. Encode a reference set once and pass the 
+        result to detect() as target_embeddings to skip the target backbone.
+        targets: List of target sets [K, h, w, 3]. With config.UINT8_INPUT 
+            these are uint8 pixels as returned by get_one_target. All sets 
+            need the same K, which may differ from config.NUM_TARGETS.
+        Returns [len(targets), 5 pyramid levels, FPN_FEATUREMAPS]
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        # CHANGE: Removed moding of target -> detect expects molded target
+        # molded_targets, target_metas, target_windows = self.mold_inputs(targets)
+        molded_targets = np.stack(targets)
+        if self.config.UINT8_INPUT:
+            molded_targets = molded_targets.astype(np.uint8)
+        if verbose:
+            modellib.log("molded_targets", molded_targets)
+        return self.target_encoder.predict(molded_targets, verbose=0)
+    
+    def detect(self, targets, images, verbose=0, random_detections=False, eps=1e-6, target_embeddings=None):
         """Runs the detection pipeline.
         images: List of images, potentially of different sizes.
+        targets: List of target sets [NUM_TARGETS, h, w, 3]. With 
+            config.UINT8_INPUT these are uint8 pixels as returned by get_one_target.
+        target_embeddings: Optional. Output of encode_targets to use instead 
+            of targets. A single embedding is used for all images.
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks as siamese_utils.CropMasks,
+            use np.asarray(masks) for a full size array
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -726,15 +985,17 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
             modellib.log("Processing {} images".format(len(images)))
             for image in images:
                 modellib.log("image", image)
+            if target_embeddings is None:
                 # CHANGE: added target to logs
                 modellib.log("target", np.stack(targets))
 
         # Mold inputs to format expected by the neural network
-        # CHANGE: Removed moding of target -> detect expects molded target
-        # TODO!
         molded_images, image_metas, windows = self.mold_inputs(images)
-        # molded_targets, target_metas, target_windows = self.mold_inputs(targets)
-        molded_targets = np.stack(targets)
+        # CHANGE: Encode the targets unless their embeddings are given
+        if target_embeddings is None:
+            target_embeddings = self.encode_targets(targets, verbose=verbose)
+        if target_embeddings.shape[0] == 1:
+            target_embeddings = np.repeat(target_embeddings, len(images), axis=0)
 
         # Validate image sizes
         # All images in a batch MUST be of the same size
@@ -742,48 +1003,22 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
         for g in molded_images[1:]:
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
-        # CHANGE: add size assertion for target
-        target_shape = molded_targets[0].shape
-        for g in molded_targets[1:]:
-            assert g.shape == target_shape,\
-                "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        # Anchors, duplicated across the batch dimension because Keras requires it
+        anchors = self.get_batch_anchors(image_shape, self.config.BATCH_SIZE)
 
         if verbose:
             modellib.log("molded_images", molded_images)
 #             modellib.log("image_metas", image_metas)
-            # CHANGE: add targets to log
-            modellib.log("molded_targets", molded_targets)
-#             modellib.log("target_metas", target_metas)
+            # CHANGE: add target embeddings to log
+            modellib.log("target_embeddings", target_embeddings)
             modellib.log("anchors", anchors)
         # Run object detection
         # CHANGE: Use siamese detection model
         detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, molded_targets, anchors], verbose=0)
+            self.keras_model.predict([molded_images, image_metas, target_embeddings, anchors], verbose=0)
         if random_detections:
-            # Randomly shift the detected boxes
-            window_limits = utils.norm_boxes(windows, (molded_images[0].shape[:2]))[0]
-            y_shifts = np.random.uniform(-detections[0,:,0] + window_limits[0], window_limits[2] - detections[0,:,2])
-            x_shifts = np.random.uniform(-detections[0,:,1] + window_limits[1], window_limits[3] - detections[0,:,3])
-            zeros    = np.zeros(detections.shape[1])
-            shifts   = np.stack([y_shifts, x_shifts, y_shifts, x_shifts, zeros, zeros], axis=-1)[np.newaxis]
-            detections = detections + shifts
-
-            # Randomly permute confidence scores
-
-            non_zero_confidences = np.where(detections[0,:,-1])[0]
-            random_perm = np.random.permutation(non_zero_confidences)
-            permuted_confidences = np.concatenate([detections[0,:,-1][:len(non_zero_confidences)][random_perm],
-                                                   np.zeros(detections.shape[1] - len(non_zero_confidences))])
-            detections = np.concatenate([detections[:,:,:-1], permuted_confidences.reshape(1, detections.shape[1], 1)], axis=-1)
-
-            # Keep the sorted order of confidence scores
-            detections = detections[:, np.argsort(-detections[0,:,-1]), :]
+            detections[0] = self.randomize_detections(detections[0], windows[0], molded_images[0].shape)
         # Process detections
         results = []
         for i, image in enumerate(images):
@@ -799,6 +1034,226 @@ class SiameseMaskRCNN(modellib.MaskRCNN):
             })
         return results
     
+    def get_anchors(self, image_shape):
+        """Returns the normalized anchor pyramid for the given image size.
+        CHANGE: Anchors come from the registry shared with the data generators
+        (see siamese_utils.get_anchors) instead of a cache per model.
+        """
+        # Latest anchors in pixel coordinates, as in MaskRCNN.get_anchors
+        self.anchors = siamese_utils.get_anchors(self.config, image_shape)
+        return siamese_utils.get_anchors(self.config, image_shape, normalized=True)
+    
+    def get_batch_anchors(self, image_shape, batch_size):
+        """Returns the normalized anchors of get_anchors across the batch 
+        dimension [batch_size, anchor_count, 4]. This is a read-only broadcast 
+        view, predict() only copies the slices of each batch it runs.
+        """
+        anchors = self.get_anchors(image_shape)
+        return np.broadcast_to(anchors, (batch_size,) + anchors.shape)
+    
+    def detect_batch(self, targets, images, verbose=0, random_detections=False, target_embeddings=None):
+        """Runs the detection pipeline on any number of images. Images that mold
+        to the same shape are grouped, and every BATCH_SIZE images of a group 
+        run in one predict() call. The last batch of a group is padded.
+        The graph is built for config.BATCH_SIZE images, so that bounds the 
+        images per call. Build the inference model with a larger 
+        IMAGES_PER_GPU to run larger batches.
+        targets: List of target sets [NUM_TARGETS, h, w, 3], one per image or a
+            single one for all images, see detect()
+        images: List of images, potentially of different sizes.
+        target_embeddings: Optional. Output of encode_targets to use instead 
+            of targets.
+        Returns a list of dicts, one per image in the order of images, see detect()
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        if target_embeddings is None:
+            target_embeddings = self.encode_targets(targets, verbose=verbose)
+        if target_embeddings.shape[0] == 1:
+            target_embeddings = np.repeat(target_embeddings, len(images), axis=0)
+        assert target_embeddings.shape[0] == len(images), "Need one target set per image or a single one"
+        
+        batch_size = self.config.BATCH_SIZE
+        if verbose:
+            modellib.log("Processing {} images in batches of {}".format(len(images), batch_size))
+        
+        results = [None] * len(images)
+        
+        def run_bucket(bucket):
+            indices = [b[0] for b in bucket]
+            molded_images = np.stack([b[1] for b in bucket])
+            image_metas = np.stack([b[2] for b in bucket])
+            embeddings = target_embeddings[indices]
+            # Pad to BATCH_SIZE by repeating the last image
+            padding = batch_size - len(bucket)
+            if padding:
+                molded_images = np.concatenate([molded_images, np.repeat(molded_images[-1:], padding, axis=0)])
+                image_metas = np.concatenate([image_metas, np.repeat(image_metas[-1:], padding, axis=0)])
+                embeddings = np.concatenate([embeddings, np.repeat(embeddings[-1:], padding, axis=0)])
+            anchors = self.get_batch_anchors(molded_images.shape[1:], molded_images.shape[0])
+            detections, _, _, mrcnn_mask, _, _, _ =\
+                self.keras_model.predict([molded_images, image_metas, embeddings, anchors], 
+                                         batch_size=batch_size, verbose=0)
+            for i, (index, molded_image, _, window) in enumerate(bucket):
+                if random_detections:
+                    detections[i] = self.randomize_detections(detections[i], window, molded_image.shape)
+                final_rois, final_class_ids, final_scores, final_masks =\
+                    self.unmold_detections(detections[i], mrcnn_mask[i],
+                                           images[index].shape, molded_image.shape,
+                                           window)
+                results[index] = {
+                    "rois": final_rois,
+                    "class_ids": final_class_ids,
+                    "scores": final_scores,
+                    "masks": final_masks,
+                }
+        
+        # Mold images one by one and run a bucket as soon as it is full
+        buckets = {}
+        for index, image in enumerate(images):
+            molded_images, image_metas, windows = self.mold_inputs([image])
+            bucket = buckets.setdefault(molded_images.shape[1:], [])
+            bucket.append((index, molded_images[0], image_metas[0], windows[0]))
+            if len(bucket) >= batch_size:
+                run_bucket(bucket)
+                del buckets[molded_images.shape[1:]]
+        for bucket in buckets.values():
+            run_bucket(bucket)
+        return results
+    
+    def detect_multi_target(self, targets, image, verbose=0, random_detections=False, target_embeddings=None):
+        """Detects the instances of several target sets in one image. The image 
+        backbone and FPN run only once, the siamese heads then compare the 
+        image pyramid with BATCH_SIZE target sets per run.
+        targets: List of K target sets [NUM_TARGETS, h, w, 3], see detect()
+        image: The image
+        target_embeddings: Optional. [K, 5, FPN_FEATUREMAPS] output of 
+            encode_targets to use instead of targets.
+        Returns a list of K dicts, one per target set, see detect()
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        if target_embeddings is None:
+            target_embeddings = self.encode_targets(targets, verbose=verbose)
+        
+        # Image pyramid, repeated to fill the batch of the heads
+        batch_size = self.config.BATCH_SIZE
+        molded_images, image_metas, windows = self.mold_inputs([image])
+        image_pyramid = self.image_encoder.predict(molded_images, verbose=0)
+        image_pyramid = [np.repeat(p, batch_size, axis=0) for p in image_pyramid]
+        image_metas = np.repeat(image_metas, batch_size, axis=0)
+        anchors = self.get_batch_anchors(molded_images[0].shape, batch_size)
+        
+        if verbose:
+            modellib.log("Processing {} target sets".format(target_embeddings.shape[0]))
+            modellib.log("molded_images", molded_images)
+            modellib.log("target_embeddings", target_embeddings)
+        
+        results = []
+        for start in range(0, target_embeddings.shape[0], batch_size):
+            embeddings = target_embeddings[start:start + batch_size]
+            n = embeddings.shape[0]
+            if n < batch_size:
+                # Pad the last batch
+                embeddings = np.concatenate([embeddings, np.repeat(embeddings[-1:], batch_size - n, axis=0)])
+            detections, _, _, mrcnn_mask, _, _, _ =\
+                self.siamese_heads.predict(image_pyramid + [image_metas, embeddings, anchors], verbose=0)
+            for i in range(n):
+                if random_detections:
+                    detections[i] = self.randomize_detections(detections[i], windows[0], molded_images[0].shape)
+                final_rois, final_class_ids, final_scores, final_masks =\
+                    self.unmold_detections(detections[i], mrcnn_mask[i],
+                                           image.shape, molded_images[0].shape,
+                                           windows[0])
+                results.append({
+                    "rois": final_rois,
+                    "class_ids": final_class_ids,
+                    "scores": final_scores,
+                    "masks": final_masks,
+                })
+        return results
+    
+    def randomize_detections(self, detections, window, image_shape):
+        """Random baseline: shifts the detected boxes randomly within the image 
+        window and permutes their confidence scores.
+        detections: [N, (y1, x1, y2, x2, class_id, score)] of one image in 
+            normalized coordinates, sorted by score
+        window: (y1, x1, y2, x2) of the image in the molded image
+        image_shape: Shape of the molded image
+        Returns the randomized detections, sorted by score
+        """
+        # Randomly shift the detected boxes
+        window_limits = utils.norm_boxes(window, image_shape[:2])
+        y_shifts = np.random.uniform(-detections[:,0] + window_limits[0], window_limits[2] - detections[:,2])
+        x_shifts = np.random.uniform(-detections[:,1] + window_limits[1], window_limits[3] - detections[:,3])
+        zeros    = np.zeros(detections.shape[0])
+        shifts   = np.stack([y_shifts, x_shifts, y_shifts, x_shifts, zeros, zeros], axis=-1)
+        detections = detections + shifts
+
+        # Randomly permute confidence scores
+        non_zero_confidences = np.where(detections[:,-1])[0]
+        random_perm = np.random.permutation(non_zero_confidences)
+        permuted_confidences = np.concatenate([detections[:,-1][:len(non_zero_confidences)][random_perm],
+                                               np.zeros(detections.shape[0] - len(non_zero_confidences))])
+        detections = np.concatenate([detections[:,:-1], permuted_confidences.reshape(detections.shape[0], 1)], axis=-1)
+
+        # Keep the sorted order of confidence scores
+        return detections[np.argsort(-detections[:,-1]), :]
+    
+    def export_inference_graph(self, export_dir, targets=True, verbose=1):
+        """Writes a frozen inference graph that lib.serving.FrozenSiameseMaskRCNN
+        runs without Keras and the lib layer code. Variables are converted to
+        constants, only the inference outputs and the nodes they need are
+        kept, constants and batch norms are folded. The image pyramid is
+        exported as well, so one image can be compared with many targets
+        without rerunning the backbone (see serving.IMAGE_PYRAMID_OUTPUTS).
+        export_dir: Directory for the graph and its json spec (see lib.serving)
+        targets: Include the target encoder. Otherwise the graph only takes
+            precomputed target embeddings (see encode_targets).
+        Returns the path of the graph.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        from tensorflow.tools.graph_transforms import TransformGraph
+        from lib import serving
+
+        inputs = dict(zip(["image", "image_meta", "target_embedding", "anchors"], self.keras_model.inputs))
+        output_names = ["detections", "mrcnn_class", "mrcnn_bbox", "mrcnn_mask"]
+        outputs = dict(zip(output_names if self.config.MODEL == 'mrcnn' else output_names[:3] + output_names[4:],
+                           self.keras_model.outputs))
+        outputs = {name: outputs[name] for name in ["detections", "mrcnn_mask"] if name in outputs}
+        outputs.update(zip(serving.IMAGE_PYRAMID_OUTPUTS, self.image_encoder.outputs))
+        if targets:
+            inputs["target"] = self.target_encoder.inputs[0]
+            outputs["target_embedding"] = self.target_encoder.outputs[0]
+        input_nodes = [t.op.name for t in inputs.values()]
+        output_nodes = [t.op.name for t in outputs.values()]
+
+        session = K.get_session()
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session, session.graph.as_graph_def(), output_nodes)
+        # Fix the Keras learning phase to inference, if anything still uses it
+        learning_phase = K.learning_phase()
+        if any(node.name == learning_phase.op.name for node in graph_def.node):
+            with tf.Graph().as_default() as graph:
+                tf.import_graph_def(graph_def, input_map={learning_phase.name: tf.constant(False)}, name="")
+                graph_def = tf.graph_util.extract_sub_graph(graph.as_graph_def(), output_nodes)
+        graph_def = TransformGraph(graph_def, input_nodes, output_nodes,
+                                   ["remove_nodes(op=CheckNumerics)", "fold_constants(ignore_errors=true)",
+                                    "fold_batch_norms", "fold_old_batch_norms"])
+
+        os.makedirs(export_dir, exist_ok=True)
+        graph_path = os.path.join(export_dir, serving.GRAPH_FILENAME)
+        with open(graph_path, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        config = {key: getattr(self.config, key) for key in serving.SPEC_CONFIG_KEYS}
+        config = {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in config.items()}
+        spec = {"inputs": {name: t.name for name, t in inputs.items()},
+                "outputs": {name: t.name for name, t in outputs.items()},
+                "config": config}
+        with open(os.path.join(export_dir, serving.SPEC_FILENAME), "w") as f:
+            json.dump(spec, f, indent=1)
+        if verbose:
+            modellib.log("Exported {} nodes to {}".format(len(graph_def.node), graph_path))
+        return graph_path
+
     def get_imagenet_weights(self, pretraining='imagenet-1k'):
         """Selects ImageNet trained weights.
         Returns path to weights file.
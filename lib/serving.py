@@ -0,0 +1,283 @@
+# Siamese Mask R-CNN Serving
+# Runs a frozen inference graph written by SiameseMaskRCNN.export_inference_graph
+# with TensorFlow and numpy only, without building the Keras model.
+
+import tensorflow as tf
+import sys
+import os
+import json
+import numpy as np
+
+MASK_RCNN_MODEL_PATH = 'Mask_RCNN/'
+
+if MASK_RCNN_MODEL_PATH not in sys.path:
+    sys.path.append(MASK_RCNN_MODEL_PATH)
+
+# mrcnn.utils only depends on numpy, scipy and skimage
+from mrcnn import utils
+from lib.masks import CropMasks
+
+GRAPH_FILENAME = "siamese_mrcnn_inference.pb"
+SPEC_FILENAME = "siamese_mrcnn_inference.json"
+
+# Config values the loader needs to mold inputs and unmold detections
+SPEC_CONFIG_KEYS = ["MODEL", "BATCH_SIZE", "NUM_CLASSES", "UINT8_INPUT", "MEAN_PIXEL",
+                    "IMAGE_RESIZE_MODE", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM", "IMAGE_MIN_SCALE",
+                    "TARGET_SHAPE", "BACKBONE_STRIDES", "RPN_ANCHOR_SCALES", "RPN_ANCHOR_RATIOS",
+                    "RPN_ANCHOR_STRIDE", "FPN_FEATUREMAPS"]
+
+# Outputs with the image pyramid, fed back to compare one image with many targets
+IMAGE_PYRAMID_OUTPUTS = ["image_P{}".format(i) for i in range(2, 7)]
+
+# Graph transforms of quantize_inference_graph
+# weights8: 8 bit weights, dequantized to float32 when the graph is loaded
+QUANTIZATION_TRANSFORMS = {
+    "weights8": ["quantize_weights"],
+}
+
+
+class ExportedConfig(object):
+    """The config values saved with an exported graph, as attributes."""
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+class FrozenSiameseMaskRCNN(object):
+    """Siamese Mask R-CNN from an exported frozen graph, with the detect,
+    detect_multi_target and encode_targets interface of SiameseMaskRCNN in
+    inference mode, so it can be passed to siamese_utils.evaluate_dataset.
+    export_dir: Directory written by SiameseMaskRCNN.export_inference_graph
+        or quantize_inference_graph
+    config: Optional. Config of the exported model. Needed for evaluation,
+        which draws targets with the full config. Defaults to the exported values.
+    session_config: Optional. tf.ConfigProto of the session, e.g. to set the
+        number of CPU threads
+    """
+
+    def __init__(self, export_dir, config=None, session_config=None):
+        self.export_dir = export_dir
+        with open(os.path.join(export_dir, SPEC_FILENAME)) as f:
+            self.spec = json.load(f)
+        self.config = config or ExportedConfig(self.spec["config"])
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, GRAPH_FILENAME), "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        self.inputs = {name: self.graph.get_tensor_by_name(tensor)
+                       for name, tensor in self.spec["inputs"].items()}
+        self.outputs = {name: self.graph.get_tensor_by_name(tensor)
+                        for name, tensor in self.spec["outputs"].items()}
+        self._anchors = {}
+
+    def close(self):
+        self.session.close()
+
+    def encode_targets(self, targets, verbose=0):
+        """Encodes target sets to target embeddings, see
+        SiameseMaskRCNN.encode_targets. Requires an export with targets.
+        targets: List of target sets [K, h, w, 3]
+        Returns [len(targets), 5 pyramid levels, FPN_FEATUREMAPS]
+        """
+        assert "target" in self.inputs, "The graph was exported without the target encoder."
+        dtype = np.uint8 if self.config.UINT8_INPUT else np.float32
+        return self.session.run(self.outputs["target_embedding"],
+                                {self.inputs["target"]: np.stack(targets).astype(dtype)})
+
+    def mold_inputs(self, images):
+        """Resizes images and builds their image metas, see MaskRCNN.mold_inputs."""
+        config = self.config
+        molded_images = []
+        image_metas = []
+        windows = []
+        for image in images:
+            molded_image, window, scale, padding, crop = utils.resize_image(
+                image,
+                min_dim=config.IMAGE_MIN_DIM,
+                min_scale=config.IMAGE_MIN_SCALE,
+                max_dim=config.IMAGE_MAX_DIM,
+                mode=config.IMAGE_RESIZE_MODE)
+            if config.UINT8_INPUT:
+                molded_image = molded_image.astype(np.uint8)
+            else:
+                molded_image = molded_image.astype(np.float32) - np.array(config.MEAN_PIXEL)
+            # Same layout as modellib.compose_image_meta
+            image_meta = np.array([0] + list(image.shape) + list(molded_image.shape) +
+                                  list(window) + [scale] + [0] * config.NUM_CLASSES)
+            molded_images.append(molded_image)
+            windows.append(window)
+            image_metas.append(image_meta)
+        return np.stack(molded_images), np.stack(image_metas), np.stack(windows)
+
+    def get_anchors(self, image_shape):
+        """Returns the normalized anchors of an image shape, see MaskRCNN.get_anchors."""
+        key = tuple(image_shape[:2])
+        if key not in self._anchors:
+            config = self.config
+            backbone_shapes = np.array([[int(np.ceil(image_shape[0] / stride)),
+                                         int(np.ceil(image_shape[1] / stride))]
+                                        for stride in config.BACKBONE_STRIDES])
+            anchors = utils.generate_pyramid_anchors(
+                config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS, backbone_shapes,
+                config.BACKBONE_STRIDES, config.RPN_ANCHOR_STRIDE)
+            self._anchors[key] = utils.norm_boxes(anchors, image_shape[:2]).astype(np.float32)
+        return self._anchors[key]
+
+    def detect(self, targets, images, verbose=0, target_embeddings=None):
+        """Runs the detection pipeline, see SiameseMaskRCNN.detect. Batches
+        smaller than BATCH_SIZE are padded.
+        images: List of up to BATCH_SIZE images
+        targets: List of target sets [K, h, w, 3]. Ignored if target_embeddings
+            are given.
+        target_embeddings: Optional. Output of encode_targets, a single
+            embedding is used for all images.
+        Returns a list of dicts, one dict per image, with rois, class_ids,
+        scores and masks as CropMasks [H, W, N], None for graphs without masks.
+        """
+        assert len(images) <= self.config.BATCH_SIZE, "len(images) must be at most BATCH_SIZE"
+        if target_embeddings is None:
+            target_embeddings = self.encode_targets(targets)
+        if target_embeddings.shape[0] == 1:
+            target_embeddings = np.repeat(target_embeddings, len(images), axis=0)
+        molded_images, image_metas, windows = self.mold_inputs(images)
+        outputs = self.run_detection(molded_images, image_metas, target_embeddings)
+        return [self.unmold_detections(outputs["detections"][i], outputs.get("mrcnn_mask", [None] * len(images))[i],
+                                       image.shape, molded_images[i].shape, windows[i])
+                for i, image in enumerate(images)]
+
+    def detect_multi_target(self, targets, image, verbose=0, random_detections=False, target_embeddings=None):
+        """Detects the instances of several target sets in one image, see
+        SiameseMaskRCNN.detect_multi_target. The image backbone runs once and
+        its pyramid is fed to the heads for every batch of BATCH_SIZE target
+        sets. Graphs exported without the pyramid outputs rerun the backbone.
+        Returns a list of dicts, one per target set, see detect()
+        """
+        assert not random_detections, "random_detections needs the Keras model."
+        if target_embeddings is None:
+            target_embeddings = self.encode_targets(targets)
+        molded_images, image_metas, windows = self.mold_inputs([image])
+        image_pyramid = None
+        if all(name in self.outputs for name in IMAGE_PYRAMID_OUTPUTS):
+            image_pyramid = self.session.run([self.outputs[name] for name in IMAGE_PYRAMID_OUTPUTS],
+                                             {self.inputs["image"]: molded_images})
+        batch_size = self.config.BATCH_SIZE
+        results = []
+        for start in range(0, target_embeddings.shape[0], batch_size):
+            embeddings = target_embeddings[start:start + batch_size]
+            n = embeddings.shape[0]
+            outputs = self.run_detection(np.repeat(molded_images, n, axis=0),
+                                         np.repeat(image_metas, n, axis=0), embeddings,
+                                         image_pyramid=image_pyramid)
+            for i in range(n):
+                results.append(self.unmold_detections(
+                    outputs["detections"][i], outputs.get("mrcnn_mask", [None] * n)[i],
+                    image.shape, molded_images[0].shape, windows[0]))
+        return results
+
+    def run_detection(self, molded_images, image_metas, target_embeddings, image_pyramid=None):
+        """Runs the detection graph on up to BATCH_SIZE molded images, padding
+        the batch. Returns a dict of the graph outputs without the padding.
+        image_pyramid: Optional. Pyramid outputs of one image to feed instead
+            of running the backbone on molded_images, which must all be that image.
+        """
+        batch_size = self.config.BATCH_SIZE
+        n = molded_images.shape[0]
+        if n < batch_size:
+            molded_images, image_metas, target_embeddings = [
+                np.concatenate([x, np.repeat(x[-1:], batch_size - n, axis=0)])
+                for x in [molded_images, image_metas, target_embeddings]]
+        anchors = self.get_anchors(molded_images.shape[1:])
+        anchors = np.broadcast_to(anchors, (batch_size,) + anchors.shape)
+        feed = {self.inputs["image_meta"]: image_metas,
+                self.inputs["target_embedding"]: target_embeddings,
+                self.inputs["anchors"]: anchors}
+        if image_pyramid is None:
+            feed[self.inputs["image"]] = molded_images
+        else:
+            feed.update({self.outputs[name]: np.repeat(level[:1], batch_size, axis=0)
+                         for name, level in zip(IMAGE_PYRAMID_OUTPUTS, image_pyramid)})
+        fetches = {name: self.outputs[name] for name in ["detections", "mrcnn_mask"] if name in self.outputs}
+        outputs = self.session.run(fetches, feed)
+        return {name: output[:n] for name, output in outputs.items()}
+
+    def unmold_detections(self, detections, mrcnn_mask, original_image_shape, image_shape, window):
+        """Reformats the detections of one image, see SiameseMaskRCNN.unmold_detections.
+        masks are CropMasks, or None if the graph has no mask head."""
+        # Detections array is padded with zeros. Find the first class_id == 0.
+        zero_ix = np.where(detections[:, 4] == 0)[0]
+        N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+        boxes = detections[:N, :4]
+        class_ids = detections[:N, 4].astype(np.int32)
+        scores = detections[:N, 5]
+        # Boxes in pixel coordinates of the original image
+        wy1, wx1, wy2, wx2 = utils.norm_boxes(window, image_shape[:2])
+        boxes = (boxes - np.array([wy1, wx1, wy1, wx1])) / np.array([wy2 - wy1, wx2 - wx1, wy2 - wy1, wx2 - wx1])
+        boxes = utils.denorm_boxes(boxes, original_image_shape[:2])
+        # Filter out detections with zero area
+        keep_ix = np.where((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) > 0)[0]
+        result = {"rois": boxes[keep_ix], "class_ids": class_ids[keep_ix], "scores": scores[keep_ix],
+                  "masks": None}
+        if mrcnn_mask is not None:
+            masks = mrcnn_mask[np.arange(N), :, :, class_ids][keep_ix]
+            result["masks"] = CropMasks.unmold(masks, result["rois"], original_image_shape)
+        return result
+
+
+def quantize_inference_graph(export_dir, quantized_dir, mode="weights8"):
+    """Writes a quantized copy of an exported inference graph for CPU inference.
+    export_dir: Directory written by SiameseMaskRCNN.export_inference_graph
+    quantized_dir: Output directory, loaded with FrozenSiameseMaskRCNN
+    mode: "weights8" stores 8 bit weights only, which shrinks the graph about
+        4x but computes in float32.
+    Returns the path of the quantized graph.
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+    assert mode in QUANTIZATION_TRANSFORMS, "mode must be one of {}".format(list(QUANTIZATION_TRANSFORMS))
+    with open(os.path.join(export_dir, SPEC_FILENAME)) as f:
+        spec = json.load(f)
+    graph_def = tf.GraphDef()
+    with open(os.path.join(export_dir, GRAPH_FILENAME), "rb") as f:
+        graph_def.ParseFromString(f.read())
+    input_nodes = [name.split(":")[0] for name in spec["inputs"].values()]
+    output_nodes = [name.split(":")[0] for name in spec["outputs"].values()]
+
+    graph_def = TransformGraph(graph_def, input_nodes, output_nodes, QUANTIZATION_TRANSFORMS[mode])
+    graph_def = restore_constant_weights(graph_def)
+
+    os.makedirs(quantized_dir, exist_ok=True)
+    graph_path = os.path.join(quantized_dir, GRAPH_FILENAME)
+    with open(graph_path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    spec["quantization"] = mode
+    with open(os.path.join(quantized_dir, SPEC_FILENAME), "w") as f:
+        json.dump(spec, f, indent=1)
+    return graph_path
+
+
+def restore_constant_weights(graph_def):
+    """Replaces quantized weights that hold a single value, e.g. zero biases,
+    with float32 constants. quantize_weights gives them an empty range, which
+    Dequantize turns into NaN. Returns the graph_def, modified in place.
+    """
+    nodes = {node.name: node for node in graph_def.node}
+    restored = []
+    for node in graph_def.node:
+        if node.op != "Dequantize":
+            continue
+        quantized, min_range, max_range = [tf.make_ndarray(nodes[name.split(":")[0]].attr["value"].tensor)
+                                           for name in node.input]
+        if max_range - min_range > np.finfo(np.float32).tiny:
+            continue
+        value = np.full(quantized.shape, min_range, dtype=np.float32)
+        restored.append(tf.NodeDef(name=node.name, op="Const"))
+        restored[-1].attr["dtype"].type = tf.float32.as_datatype_enum
+        restored[-1].attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value))
+    unused = {name.split(":")[0] for node in restored for name in nodes[node.name].input}
+    replaced = {node.name: node for node in restored}
+    kept = [replaced.get(node.name, node) for node in graph_def.node if node.name not in unused]
+    del graph_def.node[:]
+    graph_def.node.extend(kept)
+    return graph_def
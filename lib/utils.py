@@ -4,11 +4,18 @@ import tensorflow as tf
 import sys
 import os
 import time
+import copy
+import json
+import hashlib
+import tempfile
 import random
+import collections
+import multiprocessing
 import numpy as np
 import skimage.io
 import skimage.transform as skt
 import imgaug
+import keras
 import matplotlib.pyplot as plt
 plt.rcParams['figure.figsize'] = (12.0, 6.0)
 
@@ -24,47 +31,181 @@ from mrcnn import visualize
 
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
+from pycocotools import mask as maskUtils
+
+from lib.masks import CropMasks, bilinear_resize_weights
     
 import warnings
 warnings.filterwarnings("ignore")
     
 ### Data Generator ###
+
+class DataProfiler(object):
+    """Optional instrumentation of the data pipeline. Pass one as profiler to
+    siamese_data_generator, SiameseDataSequence, load_siamese_sample, 
+    load_image_gt or get_one_target. It records wall time histograms per 
+    stage (load_image, resize_image, augmentation, masks, targets, rpn_targets,
+    batch, ...) and counts of events such as skipped images, target attempts
+    and errors. Read report() for a dict or summary() for one line.
+    log_every: Optional. Seconds between summary() log lines of the generators.
+    With multiprocessing workers every process records into its own copy.
+    """
+    # Upper edges of the histogram bins in milliseconds, the last bin is open
+    BINS_MS = np.array([0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000])
+    
+    def __init__(self, log_every=0):
+        self.log_every = log_every
+        self.reset()
+        
+    def reset(self):
+        self.totals = collections.OrderedDict()
+        self.maxima = {}
+        self.histograms = {}
+        self.counts = collections.Counter()
+        self.last_log = time.time()
+        
+    def stage(self, name):
+        """Context manager that adds its wall time to stage name."""
+        return _ProfilerStage(self, name)
+    
+    def add(self, name, seconds):
+        if name not in self.totals:
+            self.totals[name] = 0.
+            self.maxima[name] = 0.
+            self.histograms[name] = np.zeros([len(self.BINS_MS) + 1], dtype=np.int64)
+        self.totals[name] += seconds
+        self.maxima[name] = max(self.maxima[name], seconds)
+        self.histograms[name][np.searchsorted(self.BINS_MS, seconds * 1000)] += 1
+        
+    def count(self, name, n=1):
+        self.counts[name] += n
+        
+    def report(self):
+        """Returns {"stages": {name: {count, total, mean, max, histogram}},
+        "counts": {name: count}, "bins_ms": BINS_MS}. Times are in seconds."""
+        stages = collections.OrderedDict()
+        for name, total in self.totals.items():
+            count = int(np.sum(self.histograms[name]))
+            stages[name] = {"count": count, "total": total, "mean": total / count,
+                            "max": self.maxima[name], "histogram": self.histograms[name].tolist()}
+        return {"stages": stages, "counts": dict(self.counts), "bins_ms": self.BINS_MS.tolist()}
+    
+    def summary(self):
+        """Returns one line with the mean time per stage and all counts."""
+        stages = ["{} {:.1f}ms".format(name, 1000 * s["mean"]) 
+                  for name, s in self.report()["stages"].items()]
+        counts = ["{} {}".format(name, count) for name, count in sorted(self.counts.items())]
+        return " | ".join([", ".join(stages), ", ".join(counts)])
+    
+    def maybe_log(self):
+        """Logs summary() if log_every seconds passed since the last one."""
+        if self.log_every and time.time() - self.last_log >= self.log_every:
+            modellib.log("Data pipeline: " + self.summary())
+            self.last_log = time.time()
+    
+class _ProfilerStage(object):
+    
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        
+    def __enter__(self):
+        self.start = time.time()
+        
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.time() - self.start)
+        
+class _NoStage(object):
+    
+    def __enter__(self):
+        pass
     
-def get_one_target(category, dataset, config, augmentation=None, target_size_limit=0, max_attempts=10, return_all=False, return_original_size=False):
+    def __exit__(self, *args):
+        pass
+    
+_no_stage = _NoStage()
 
-    n_attempts = 0
-    while True:
-        # Get index with corresponding images for each category
-        category_image_index = dataset.category_image_index
-        # Draw a random image
-        random_image_id = np.random.choice(category_image_index[category])
-        # Load image    
-        target_image, target_image_meta, target_class_ids, target_boxes, target_masks = \
-            modellib.load_image_gt(dataset, config, random_image_id, augmentation=augmentation,
-                          use_mini_mask=config.USE_MINI_MASK)
-        # print(random_image_id, category, target_class_ids)
-        
-        if not np.any(target_class_ids == category):
-            continue
+def _profile(profiler, name):
+    """Returns profiler.stage(name), or a no-op context without profiler."""
+    return _no_stage if profiler is None else profiler.stage(name)
+
+def _count(profiler, name, n=1):
+    if profiler is not None:
+        profiler.count(name, n)
+
+class _SeededRandomState(object):
+    """Seeds the numpy, random and imgaug RNGs from seed on enter and restores
+    their previous states on exit. Returns a np.random.RandomState for further
+    draws with the same seed."""
+    
+    def __init__(self, seed):
+        self.seed = seed
+        
+    def __enter__(self):
+        self.states = (np.random.get_state(), random.getstate(), 
+                       imgaug.current_random_state().get_state())
+        rng = np.random.RandomState(self.seed)
+        np.random.seed(rng.randint(2**31))
+        random.seed(rng.randint(2**31))
+        imgaug.seed(rng.randint(2**31))
+        return rng
+    
+    def __exit__(self, *args):
+        numpy_state, random_state, imgaug_state = self.states
+        np.random.set_state(numpy_state)
+        random.setstate(random_state)
+        imgaug.current_random_state().set_state(imgaug_state)
+    
+    
+def get_one_target(category, dataset, config, augmentation=None, target_size_limit=0, max_attempts=10, return_all=False, return_original_size=False,
+                   profiler=None):
+    """Draws a random instance of the given category and returns its resized crop.
+    If the dataset provides a category_instance_index (see IndexedCocoDataset.build_indices)
+    the instance is drawn from the index directly, otherwise random images are loaded
+    until one with a large enough instance is found.
+    target_size_limit: Minimum side length (in resized image pixels) of the target crop
+    max_attempts: Number of images to try before giving up on target_size_limit
+        (only used without an instance index)
+    profiler: Optional. DataProfiler to count target_attempts in
+    """
+    if getattr(dataset, 'category_instance_index', None) is not None:
+        _count(profiler, "target_attempts")
+        instance = draw_target_instance(category, dataset, config, target_size_limit=target_size_limit)
+        target, window, scale, padding, crop, original_size = load_target_instance(
+            dataset, config, instance, augmentation=augmentation)
+    else:
+        n_attempts = 0
+        while True:
+            # Get index with corresponding images for each category
+            category_image_index = dataset.category_image_index
+            # Draw a random image
+            random_image_id = np.random.choice(category_image_index[category])
+            _count(profiler, "target_attempts")
+            # Load image    
+            target_image, target_image_meta, target_class_ids, target_boxes, target_masks = \
+                load_image_gt(dataset, config, random_image_id, augmentation=augmentation,
+                              use_mini_mask=config.USE_MINI_MASK)
+            # print(random_image_id, category, target_class_ids)
+
+            if not np.any(target_class_ids == category):
+                _count(profiler, "target_retries")
+                continue
 
-        # try:
-        #     box_ind = np.random.choice(np.where(target_class_ids == category)[0])   
-        # except ValueError:
-        #     return None
-        box_ind = np.random.choice(np.where(target_class_ids == category)[0])   
-        tb = target_boxes[box_ind,:]
-        target = target_image[tb[0]:tb[2],tb[1]:tb[3],:]
-        original_size = target.shape
-        target, window, scale, padding, crop = utils.resize_image(
-            target,
-            min_dim=config.TARGET_MIN_DIM,
-            min_scale=config.IMAGE_MIN_SCALE, #Same scaling as the image
-            max_dim=config.TARGET_MAX_DIM,
-            mode=config.IMAGE_RESIZE_MODE) #Same output format as the image
-
-        n_attempts = n_attempts + 1
-        if (min(original_size[:2]) >= target_size_limit) or (n_attempts >= max_attempts):
-            break
+            box_ind = np.random.choice(np.where(target_class_ids == category)[0])   
+            tb = target_boxes[box_ind,:]
+            target = target_image[tb[0]:tb[2],tb[1]:tb[3],:]
+            original_size = target.shape
+            target, window, scale, padding, crop = utils.resize_image(
+                target,
+                min_dim=config.TARGET_MIN_DIM,
+                min_scale=config.IMAGE_MIN_SCALE, #Same scaling as the image
+                max_dim=config.TARGET_MAX_DIM,
+                mode=config.IMAGE_RESIZE_MODE) #Same output format as the image
+
+            n_attempts = n_attempts + 1
+            if (min(original_size[:2]) >= target_size_limit) or (n_attempts >= max_attempts):
+                break
+            _count(profiler, "target_retries")
     
     if return_all:
         return target, window, scale, padding, crop
@@ -72,9 +213,667 @@ def get_one_target(category, dataset, config, augmentation=None, target_size_lim
         return target, original_size
     else:
         return target
+    
+def image_resize_scale(config, image_shape):
+    """Returns the scale utils.resize_image applies to images of the given 
+    original shape(s) with the image resizing parameters of config.
+    image_shape: [..., (height, width)]
+    """
+    image_shape = np.asarray(image_shape, dtype=np.float32)
+    h, w = image_shape[..., 0], image_shape[..., 1]
+    scale = np.ones_like(h)
+    if config.IMAGE_MIN_DIM:
+        scale = np.maximum(1, config.IMAGE_MIN_DIM / np.minimum(h, w))
+    if config.IMAGE_MIN_SCALE:
+        scale = np.maximum(scale, config.IMAGE_MIN_SCALE)
+    if config.IMAGE_MAX_DIM and config.IMAGE_RESIZE_MODE == "square":
+        image_max = np.maximum(h, w)
+        scale = np.where(np.round(image_max * scale) > config.IMAGE_MAX_DIM,
+                         config.IMAGE_MAX_DIM / image_max, scale)
+    if config.IMAGE_RESIZE_MODE == "none":
+        scale = np.ones_like(h)
+    return scale
+
+def draw_target_instance(category, dataset, config, target_size_limit=0, random_state=None):
+    """Draws a random instance of a category from dataset.category_instance_index.
+    As with the original rejection sampling every image containing the category is
+    equally likely, and then every instance within that image.
+    Instances whose smaller side (in resized image pixels) is below target_size_limit
+    are excluded up front, unless no instance of the category is large enough.
+    random_state: Optional. np.random.RandomState to draw with instead of np.random
+    Returns one record of the instance index (see INSTANCE_INDEX_DTYPE).
+    """
+    random_state = random_state or np.random
+    instances = dataset.category_instance_index[category]
+    if target_size_limit:
+        scale = image_resize_scale(config, instances['image_shape'])
+        sides = np.minimum(instances['bbox'][:, 2] - instances['bbox'][:, 0],
+                           instances['bbox'][:, 3] - instances['bbox'][:, 1]) * scale
+        large_enough = instances[sides >= target_size_limit]
+        if large_enough.shape[0] > 0:
+            instances = large_enough
+    # Weight instances such that each image is drawn with equal probability
+    _, image_index, image_counts = np.unique(instances['image_id'], return_inverse=True, return_counts=True)
+    p = 1. / image_counts[image_index]
+    return instances[random_state.choice(instances.shape[0], p=p / np.sum(p))]
+
+def load_target_instance(dataset, config, instance, augmentation=None, image=None):
+    """Crops an instance straight from the decoded image using its annotated box
+    and resizes it to the target shape. If the dataset has a target_crop_store
+    for the target size of config, the resized crop is read from there instead.
+    instance: One record of the instance index (see INSTANCE_INDEX_DTYPE)
+    image: Optional. The already decoded image of the instance
+    Returns the target, the outputs of utils.resize_image and the size the crop 
+    would have had in the resized image.
+    """
+    store = getattr(dataset, 'target_crop_store', None)
+    if image is None and store is not None and store.matches(config):
+        cached = store.get(instance['annotation_id'])
+        if cached is not None:
+            target, window, scale, padding, original_size = cached
+            if augmentation:
+                target = augmentation.to_deterministic().augment_image(target)
+            return target, window, scale, padding, None, original_size
+    if image is None:
+        image = dataset.load_image(instance['image_id'])
+    y1, x1, y2, x2 = instance['bbox']
+    y1, x1 = int(np.floor(y1)), int(np.floor(x1))
+    y2 = max(int(np.ceil(y2)), y1 + 1)
+    x2 = max(int(np.ceil(x2)), x1 + 1)
+    target = image[y1:y2, x1:x2, :]
+    if augmentation:
+        target = augmentation.to_deterministic().augment_image(target)
+    image_scale = image_resize_scale(config, image.shape[:2])
+    original_size = (int(round(target.shape[0] * image_scale)), 
+                     int(round(target.shape[1] * image_scale)), 
+                     target.shape[2])
+    target, window, scale, padding, crop = utils.resize_image(
+        target,
+        min_dim=config.TARGET_MIN_DIM,
+        min_scale=config.IMAGE_MIN_SCALE, #Same scaling as the image
+        max_dim=config.TARGET_MAX_DIM,
+        mode=config.IMAGE_RESIZE_MODE) #Same output format as the image
+    return target, window, scale, padding, crop, original_size
+
+class TargetCropStore(object):
+    """Persistent store of resized target crops for all instances of a dataset.
+    The crops live in a memory-mapped uint8 array [N, TARGET_MAX_DIM, TARGET_MAX_DIM, 3]
+    (<path>.npy) next to a small index file (<path>_index.npz) with the annotation
+    ids, the resize parameters and the target size the crops were built for. 
+    Crops are keyed by annotation id and read with O(1) random access, so target
+    sampling does not need to decode any image.
+    
+    Build once with TargetCropStore.build(path, dataset, config) and attach it to 
+    a dataset with IndexedCocoDataset.load_target_crop_store(path). The store is 
+    opt-in and large: TARGET_MAX_DIM**2 * 3 bytes per instance, e.g. about 
+    24 GB for the ~860k instances of COCO train2017 at TARGET_MAX_DIM = 96.
+    Only the "square" resize mode is supported, the only one whose crops all 
+    have TARGET_SHAPE.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.crops = np.load(path + '.npy', mmap_mode='r')
+        index = np.load(path + '_index.npz')
+        self.annotation_ids = index['annotation_ids']
+        self.source_image_ids = index['source_image_ids']
+        self.windows = index['windows']
+        self.scales = index['scales']
+        self.paddings = index['paddings']
+        self.original_sizes = index['original_sizes']
+        self.target_size = tuple(index['target_size'].tolist())
+
+    def __getstate__(self):
+        # Reopen from disk instead of pickling the memory-mapped crops, so
+        # workers map the file rather than receiving a copy of it
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @staticmethod
+    def target_size_key(config):
+        """Returns the target resizing parameters crops of a store depend on."""
+        return (config.TARGET_MIN_DIM, config.TARGET_MAX_DIM, 
+                config.IMAGE_MIN_SCALE or 0, config.IMAGE_RESIZE_MODE)
+    
+    def matches(self, config):
+        """True if the stored crops have the target size of config."""
+        return self.target_size == tuple(np.array(TargetCropStore.target_size_key(config), 
+                                                  dtype=np.str_).tolist())
+    
+    def __len__(self):
+        return self.annotation_ids.shape[0]
+    
+    def get(self, annotation_id):
+        """Returns target, window, scale, padding, original_size of the crop
+        of the given annotation or None if it is not part of the store."""
+        # annotation_ids are sorted, see build()
+        ix = np.searchsorted(self.annotation_ids, annotation_id)
+        if ix >= len(self) or self.annotation_ids[ix] != annotation_id:
+            return None
+        padding = [tuple(p) for p in self.paddings[ix].tolist()]
+        return (np.array(self.crops[ix]), tuple(self.windows[ix].tolist()), float(self.scales[ix]),
+                padding, tuple(self.original_sizes[ix].tolist()))
+    
+    @classmethod
+    def build(cls, path, dataset, config, categories=None, verbose=1):
+        """Crops and resizes all instances of dataset.category_instance_index 
+        and writes them to path. Every image is decoded only once.
+        categories: Optional. Only store instances of these categories.
+        Returns the opened store.
+        """
+        target_shape = tuple(config.TARGET_SHAPE.tolist())
+        if config.IMAGE_RESIZE_MODE != "square" or \
+                target_shape != (config.TARGET_MAX_DIM, config.TARGET_MAX_DIM, 3):
+            raise Exception("TargetCropStore needs IMAGE_RESIZE_MODE 'square' and TARGET_SHAPE "
+                            "[TARGET_MAX_DIM, TARGET_MAX_DIM, 3], got {} and {}".format(
+                                config.IMAGE_RESIZE_MODE, list(target_shape)))
+        if categories is None:
+            categories = range(len(dataset.category_instance_index))
+        instances = np.concatenate([dataset.category_instance_index[c] for c in categories])
+        instances = instances[np.argsort(instances['annotation_id'], kind='mergesort')]
+        N = instances.shape[0]
+        if verbose > 0:
+            print("Allocating {} target crops of {}, {:.1f} GB".format(
+                N, target_shape, N * np.prod(target_shape) / 1e9))
+        
+        crops = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.uint8,
+                                          shape=(N,) + target_shape)
+        windows = np.zeros((N, 4), dtype=np.int32)
+        scales = np.zeros((N,), dtype=np.float64)
+        paddings = np.zeros((N, 3, 2), dtype=np.int32)
+        original_sizes = np.zeros((N, 3), dtype=np.int32)
+        
+        # Decode each image once for all its instances
+        order = np.argsort(instances['image_id'], kind='mergesort')
+        boundaries = np.where(np.diff(instances['image_id'][order]) != 0)[0] + 1
+        t_start = time.time()
+        for i, rows in enumerate(np.split(order, boundaries)):
+            if rows.shape[0] == 0:
+                continue
+            if verbose > 0 and i % 1000 == 0:
+                print("Cropping image {}/{} ...".format(i, boundaries.shape[0] + 1))
+            image = dataset.load_image(instances['image_id'][rows[0]])
+            for row in rows:
+                target, window, scale, padding, _, original_size = load_target_instance(
+                    dataset, config, instances[row], image=image)
+                crops[row] = target
+                windows[row] = window
+                scales[row] = scale
+                paddings[row] = np.array(padding)
+                original_sizes[row] = original_size
+        crops.flush()
+        del crops
+        
+        np.savez(path + '_index.npz',
+                 annotation_ids=instances['annotation_id'],
+                 source_image_ids=np.array([dataset.image_info[i]['id'] for i in instances['image_id']]),
+                 windows=windows, scales=scales, paddings=paddings, original_sizes=original_sizes,
+                 target_size=np.array(TargetCropStore.target_size_key(config), dtype=np.str_))
+        if verbose > 0:
+            print("Stored {} target crops in {:.1f}s".format(N, time.time() - t_start))
+        return cls(path)
+    
+# Augmenters that modellib.load_image_gt applies to masks
+MASK_AUGMENTERS = ["Sequential", "SomeOf", "OneOf", "Sometimes",
+                   "Fliplr", "Flipud", "CropAndPad",
+                   "Affine", "PiecewiseAffine"]
+
+def _mask_augmentation_hook(images, augmenter, parents, default):
+    return augmenter.__class__.__name__ in MASK_AUGMENTERS
+
+def augmentation_flips(augmentation):
+    """Returns whether a deterministic imgaug augmenter flips masks left/right
+    and up/down, or None if it also moves masks in other ways (CropAndPad,
+    Affine, PiecewiseAffine)."""
+    augmenters = [augmentation] + augmentation.get_all_children(flat=True)
+    if any(a.__class__.__name__ in MASK_AUGMENTERS[6:] for a in augmenters):
+        return None
+    # Follow the corners of a tiny probe through the mask augmenters
+    probe = np.arange(4, dtype=np.uint8).reshape([2, 2, 1])
+    probe = augmentation.augment_image(probe, hooks=imgaug.HooksImages(activator=_mask_augmentation_hook))
+    corner = probe[0, 0, 0]
+    return corner in (1, 3), corner in (2, 3)
+
+def _annotation_box_mask(annotation, height, width, scale, window):
+    """Rasterizes one COCO annotation at the resized image scale, but only
+    inside its box. Polygons are scaled before rasterizing, RLEs are decoded
+    at the original size and sampled at the nearest pixels.
+    Returns the box mask and its top left corner in the resized image or 
+    None if the annotation covers no pixel.
+    """
+    wy1, wx1, wy2, wx2 = window
+    segmentation = annotation['segmentation']
+    if isinstance(segmentation, list):
+        polygons = [np.array(p, dtype=np.float64).reshape([-1, 2]) * scale + [wx1, wy1] 
+                    for p in segmentation if len(p) >= 6]
+        if not polygons:
+            return None
+        points = np.concatenate(polygons, axis=0)
+        x1, y1 = np.maximum(np.floor(points.min(axis=0)).astype(np.int32), [wx1, wy1])
+        x2, y2 = np.minimum(np.ceil(points.max(axis=0)).astype(np.int32), [wx2, wy2])
+        if x2 <= x1 or y2 <= y1:
+            return None
+        rles = maskUtils.frPyObjects([(p - [x1, y1]).ravel().tolist() for p in polygons], 
+                                     int(y2 - y1), int(x2 - x1))
+        return maskUtils.decode(maskUtils.merge(rles)).astype(np.bool), y1, x1
+    
+    if isinstance(segmentation['counts'], list):
+        rle = maskUtils.frPyObjects(segmentation, height, width)
+    else:
+        rle = segmentation
+    if list(rle['size']) != [height, width]:
+        # Same as CocoDataset.load_mask, such crowd masks cover the image
+        return np.ones([wy2 - wy1, wx2 - wx1], dtype=np.bool), wy1, wx1
+    bx, by, bw, bh = maskUtils.toBbox(rle)
+    if bw <= 0 or bh <= 0:
+        return None
+    y1 = max(int(np.floor(by * scale)) + wy1, wy1)
+    x1 = max(int(np.floor(bx * scale)) + wx1, wx1)
+    y2 = min(int(np.ceil((by + bh) * scale)) + wy1, wy2)
+    x2 = min(int(np.ceil((bx + bw) * scale)) + wx1, wx2)
+    rows = np.minimum(((np.arange(y1, y2) + 0.5 - wy1) / scale).astype(np.int32), height - 1)
+    cols = np.minimum(((np.arange(x1, x2) + 0.5 - wx1) / scale).astype(np.int32), width - 1)
+    return maskUtils.decode(rle)[np.ix_(rows, cols)].astype(np.bool), y1, x1
+
+def load_image_gt(dataset, config, image_id, augmentation=None, use_mini_mask=False, profiler=None):
+    """Same as modellib.load_image_gt. For COCO images with mini masks, every
+    instance is rasterized inside its box at the resized scale (see 
+    _annotation_box_mask), flipped as the augmentation requires and resized
+    to MINI_MASK_SHAPE. The full size [height, width, instances] mask stack
+    is never built.
+    Uses modellib.load_image_gt for full size masks, other datasets, the 
+    crop resize mode and augmentations that move masks other than by flips.
+    profiler: Optional. DataProfiler to record the stages in
+    """
+    info = dataset.image_info[image_id]
+    augmentation = augmentation.to_deterministic() if augmentation else None
+    flips = augmentation_flips(augmentation) if augmentation else (False, False)
+    if not use_mini_mask or flips is None or info["source"] != "coco" or \
+            "annotations" not in info or config.IMAGE_RESIZE_MODE == "crop":
+        with _profile(profiler, "load_image_gt"):
+            return modellib.load_image_gt(dataset, config, image_id, augmentation=augmentation,
+                                          use_mini_mask=use_mini_mask)
+    
+    with _profile(profiler, "load_image"):
+        image = dataset.load_image(image_id)
+    original_shape = image.shape
+    with _profile(profiler, "resize_image"):
+        image, window, scale, padding, crop = utils.resize_image(
+            image,
+            min_dim=config.IMAGE_MIN_DIM,
+            min_scale=config.IMAGE_MIN_SCALE,
+            max_dim=config.IMAGE_MAX_DIM,
+            mode=config.IMAGE_RESIZE_MODE)
+    if augmentation:
+        with _profile(profiler, "augmentation"):
+            image_shape = image.shape
+            image = augmentation.augment_image(image)
+        assert image.shape == image_shape, "Augmentation shouldn't change image size"
+        
+    with _profile(profiler, "masks"):
+        class_ids, bbox, mask = _load_mini_masks(dataset, config, info, scale, window, flips, image.shape)
+    
+    # Active classes
+    active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
+    source_class_ids = dataset.source_class_ids[info["source"]]
+    active_class_ids[source_class_ids] = 1
+    image_meta = modellib.compose_image_meta(image_id, original_shape, image.shape,
+                                             window, scale, active_class_ids)
+    return image, image_meta, class_ids, bbox, mask
+
+def _load_mini_masks(dataset, config, info, scale, window, flips, image_shape):
+    """Returns class_ids, bbox and mini masks of a COCO image, see load_image_gt."""
+    class_ids = []
+    bbox = []
+    mini_masks = []
+    mini_shape = tuple(config.MINI_MASK_SHAPE)
+    for annotation in info["annotations"]:
+        class_id = dataset.map_source_class_id("coco.{}".format(annotation['category_id']))
+        if not class_id:
+            continue
+        box_mask = _annotation_box_mask(annotation, info["height"], info["width"], scale, window)
+        if box_mask is None:
+            continue
+        m, y1, x1 = box_mask
+        if flips[0]:
+            m = m[:, ::-1]
+            x1 = image_shape[1] - x1 - m.shape[1]
+        if flips[1]:
+            m = m[::-1, :]
+            y1 = image_shape[0] - y1 - m.shape[0]
+        # Tight box around the mask pixels, drops instances that vanished
+        rows = np.where(np.any(m, axis=1))[0]
+        cols = np.where(np.any(m, axis=0))[0]
+        if rows.shape[0] == 0:
+            continue
+        m = m[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        bbox.append([y1 + rows[0], x1 + cols[0], y1 + rows[-1] + 1, x1 + cols[-1] + 1])
+        # Bilinear resize and rounding as in utils.minimize_mask
+        m = bilinear_resize_weights(m.shape[0], mini_shape[0]).dot(m.astype(np.float32)).dot(
+            bilinear_resize_weights(m.shape[1], mini_shape[1]).T)
+        mini_masks.append(m > 0.5)
+        # Use negative class ID for crowds
+        class_ids.append(-class_id if annotation['iscrowd'] else class_id)
+    class_ids = np.array(class_ids, dtype=np.int32)
+    bbox = np.array(bbox, dtype=np.int32).reshape([-1, 4])
+    if mini_masks:
+        mask = np.stack(mini_masks, axis=2)
+    else:
+        mask = np.zeros(mini_shape + (0,), dtype=np.bool)
+    return class_ids, bbox, mask
+
+def load_siamese_sample(dataset, config, image_id, anchors, augmentation=None, random_rois=0,
+                        detection_targets=False, profiler=None):
+    """Loads one training sample: an image with the ground truth of one randomly
+    chosen active category and NUM_TARGETS targets of that category.
+    anchors: AnchorGeometry of the anchors, see siamese_data_generator
+    Returns None if the image contains no instance of an active class, otherwise
+    a dict with image, image_meta, targets, rpn_match, rpn_bbox, gt_class_ids
+    (1 for instances of the category), gt_boxes and gt_masks. With random_rois
+    also rpn_rois and, with detection_targets, rois, mrcnn_class_ids, 
+    mrcnn_bbox and mrcnn_mask.
+    profiler: Optional. DataProfiler to record the stages and skipped images in
+    """
+    # Get GT bounding boxes and masks for image.
+    image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+        load_image_gt(dataset, config, image_id, augmentation=augmentation,
+                      use_mini_mask=config.USE_MINI_MASK, profiler=profiler)
+
+    # Replace class ids with foreground/background info if binary
+    # class option is chosen
+    # if binary_classes == True:
+    #    gt_class_ids = np.minimum(gt_class_ids, 1)
+
+    # Skip images that have no instances. This can happen in cases
+    # where we train on a subset of classes and the image doesn't
+    # have any of the classes we care about.
+    if not np.any(gt_class_ids > 0):
+        _count(profiler, "skipped_no_instances")
+        return None
+
+    # Use only positive class_ids
+    categories = np.unique(gt_class_ids)
+    _idx = categories > 0
+    categories = categories[_idx]
+    # Use only active classes
+    active_categories = []
+    for c in categories:
+        if any(c == dataset.ACTIVE_CLASSES):
+            active_categories.append(c)
+
+    # Skiop image if it contains no instance of any active class    
+    if not np.any(np.array(active_categories) > 0):
+        _count(profiler, "skipped_no_active_category")
+        return None
+    # Randomly select category
+    category = np.random.choice(active_categories)
+
+    # Generate siamese target crop
+    if not config.NUM_TARGETS:
+        config.NUM_TARGETS = 1
+    targets = []
+    with _profile(profiler, "targets"):
+        for i in range(config.NUM_TARGETS):
+            targets.append(get_one_target(category, dataset, config, augmentation=augmentation,
+                                          profiler=profiler))
+
+    target_class_id = category
+    idx = gt_class_ids == target_class_id
+    siamese_class_ids = idx.astype('int8')
+    siamese_class_ids = siamese_class_ids[idx]
+    gt_class_ids = gt_class_ids[idx]
+    gt_boxes = gt_boxes[idx,:]
+    gt_masks = gt_masks[:,:,idx]
+    image_meta = image_meta[:14]
+
+    # RPN Targets
+    with _profile(profiler, "rpn_targets"):
+        rpn_match, rpn_bbox = build_rpn_targets(anchors, gt_class_ids, gt_boxes, config)
+    sample = {"image": image, "image_meta": image_meta, "targets": targets,
+              "rpn_match": rpn_match, "rpn_bbox": rpn_bbox}
+
+    # Mask R-CNN Targets
+    if random_rois:
+        with _profile(profiler, "detection_targets"):
+            sample["rpn_rois"] = modellib.generate_random_rois(
+                image.shape, random_rois, gt_class_ids, gt_boxes)
+            if detection_targets:
+                sample["rois"], sample["mrcnn_class_ids"], sample["mrcnn_bbox"], sample["mrcnn_mask"] =\
+                    modellib.build_detection_targets(
+                        sample["rpn_rois"], gt_class_ids, gt_boxes, gt_masks, config)
+
+    # If more instances than fits in the array, sub-sample from them.
+    if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+        ids = np.random.choice(
+            np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+        siamese_class_ids = siamese_class_ids[ids]
+        gt_boxes = gt_boxes[ids]
+        gt_masks = gt_masks[:, :, ids]
+
+    sample["gt_class_ids"] = siamese_class_ids
+    sample["gt_boxes"] = gt_boxes
+    sample["gt_masks"] = gt_masks
+    return sample
+
+def allocate_siamese_batch(sample, config, batch_size, anchors):
+    """Allocates the batch arrays for samples shaped like the given one
+    (see load_siamese_sample). Returns a dict of zero arrays."""
+    image = sample["image"]
+    batch = {
+        "image_meta": np.zeros(
+            (batch_size,) + sample["image_meta"].shape, dtype=sample["image_meta"].dtype),
+        "rpn_match": np.zeros(
+            [batch_size, len(anchors), 1], dtype=sample["rpn_match"].dtype),
+        "rpn_bbox": np.zeros(
+            [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=sample["rpn_bbox"].dtype),
+        "images": np.zeros(
+            (batch_size,) + image.shape, dtype=np.uint8 if config.UINT8_INPUT else np.float32),
+        "gt_class_ids": np.zeros(
+            (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32),
+        "gt_boxes": np.zeros(
+            (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32),
+        "targets": np.zeros(
+            (batch_size, config.NUM_TARGETS) + sample["targets"][0].shape, 
+            dtype=np.uint8 if config.UINT8_INPUT else np.float32),
+    }
+    if config.USE_MINI_MASK:
+        batch["gt_masks"] = np.zeros((batch_size, config.MINI_MASK_SHAPE[0], config.MINI_MASK_SHAPE[1],
+                                      config.MAX_GT_INSTANCES), dtype=np.bool)
+    else:
+        batch["gt_masks"] = np.zeros(
+            (batch_size, image.shape[0], image.shape[1], config.MAX_GT_INSTANCES), dtype=np.bool)
+    for name in ["rpn_rois", "rois", "mrcnn_class_ids", "mrcnn_bbox", "mrcnn_mask"]:
+        if name in sample:
+            batch[name] = np.zeros(
+                (batch_size,) + sample[name].shape, dtype=sample[name].dtype)
+    return batch
+
+def add_siamese_sample(batch, b, sample, config):
+    """Writes a sample (see load_siamese_sample) to position b of the batch arrays."""
+    batch["image_meta"][b] = sample["image_meta"]
+    batch["rpn_match"][b] = sample["rpn_match"][:, np.newaxis]
+    batch["rpn_bbox"][b] = sample["rpn_bbox"]
+    if config.UINT8_INPUT:
+        # Molded in the graph
+        batch["images"][b] = sample["image"]
+        batch["targets"][b] = np.stack(sample["targets"], axis=0)
+    else:
+        batch["images"][b] = modellib.mold_image(sample["image"].astype(np.float32), config)
+        batch["targets"][b] = np.stack([modellib.mold_image(target.astype(np.float32), config) 
+                                        for target in sample["targets"]], axis=0)
+    # Clear what previous samples left behind, batch arrays may be reused
+    batch["gt_class_ids"][b] = 0
+    batch["gt_boxes"][b] = 0
+    batch["gt_masks"][b] = 0
+    batch["gt_class_ids"][b, :sample["gt_class_ids"].shape[0]] = sample["gt_class_ids"]
+    batch["gt_boxes"][b, :sample["gt_boxes"].shape[0]] = sample["gt_boxes"]
+    batch["gt_masks"][b, :, :, :sample["gt_masks"].shape[-1]] = sample["gt_masks"]
+    for name in ["rpn_rois", "rois", "mrcnn_class_ids", "mrcnn_bbox", "mrcnn_mask"]:
+        if name in batch:
+            batch[name][b] = sample[name]
+
+def siamese_batch_inputs(batch):
+    """Returns the inputs and outputs lists of a full batch, see siamese_data_generator."""
+    inputs = [batch["images"], batch["image_meta"], batch["targets"], batch["rpn_match"], batch["rpn_bbox"],
+              batch["gt_class_ids"], batch["gt_boxes"], batch["gt_masks"]]
+    outputs = []
+
+    if "rpn_rois" in batch:
+        inputs.extend([batch["rpn_rois"]])
+        if "rois" in batch:
+            inputs.extend([batch["rois"]])
+            # Keras requires that output and targets have the same number of dimensions
+            outputs.extend(
+                [np.expand_dims(batch["mrcnn_class_ids"], -1), batch["mrcnn_bbox"], batch["mrcnn_mask"]])
+    return inputs, outputs
+
+_anchor_registry = {}
+
+def _anchor_registry_entry(config, image_shape):
+    backbone_shapes = modellib.compute_backbone_shapes(config, image_shape)
+    key = (tuple(int(x) for x in image_shape[:2]), 
+           tuple(tuple(int(x) for x in shape) for shape in backbone_shapes),
+           tuple(config.RPN_ANCHOR_SCALES), tuple(config.RPN_ANCHOR_RATIOS),
+           tuple(config.BACKBONE_STRIDES), config.RPN_ANCHOR_STRIDE)
+    if key not in _anchor_registry:
+        anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                 config.RPN_ANCHOR_RATIOS,
+                                                 backbone_shapes,
+                                                 config.BACKBONE_STRIDES,
+                                                 config.RPN_ANCHOR_STRIDE)
+        normalized_anchors = utils.norm_boxes(anchors, image_shape[:2])
+        anchors.setflags(write=False)
+        normalized_anchors.setflags(write=False)
+        _anchor_registry[key] = {"pixels": anchors, "normalized": normalized_anchors}
+    return _anchor_registry[key]
+
+def get_anchors(config, image_shape, normalized=False):
+    """Returns the anchor pyramid of an image shape [anchor_count, (y1, x1, y2, x2)]
+    in pixel or normalized coordinates. Anchors are generated once per image
+    shape and anchor parameters and shared by the data generators and models
+    of a process, so the arrays are read-only.
+    """
+    return _anchor_registry_entry(config, image_shape)["normalized" if normalized else "pixels"]
+
+def get_anchor_geometry(config, image_shape=None):
+    """Returns the shared AnchorGeometry of the pixel anchors of an image 
+    shape (default config.IMAGE_SHAPE), see get_anchors."""
+    entry = _anchor_registry_entry(config, config.IMAGE_SHAPE if image_shape is None else image_shape)
+    if "geometry" not in entry:
+        entry["geometry"] = AnchorGeometry(entry["pixels"])
+    return entry["geometry"]
+
+def siamese_anchors(config):
+    """Returns the anchors of config.IMAGE_SHAPE [anchor_count, (y1, x1, y2, x2)]"""
+    return get_anchors(config, config.IMAGE_SHAPE)
+
+class AnchorGeometry(object):
+    """Anchors together with their sizes, centers and areas, computed once
+    per image shape instead of for every sample in build_rpn_targets.
+    anchors: [anchor_count, (y1, x1, y2, x2)]
+    """
+    
+    def __init__(self, anchors):
+        self.anchors = anchors
+        self.shape = anchors.shape
+        self.y1, self.x1, self.y2, self.x2 = [np.ascontiguousarray(anchors[:, i]) for i in range(4)]
+        self.heights = self.y2 - self.y1
+        self.widths = self.x2 - self.x1
+        self.center_y = self.y1 + 0.5 * self.heights
+        self.center_x = self.x1 + 0.5 * self.widths
+        self.areas = self.heights * self.widths
+        
+    def __len__(self):
+        return self.shape[0]
+    
+    def overlaps(self, boxes):
+        """Same as utils.compute_overlaps(anchors, boxes) for all boxes at once.
+        boxes: [N, (y1, x1, y2, x2)]
+        Returns [anchor_count, N] IoUs, a transposed view of an [N, anchor_count]
+        array so that every box works on contiguous anchor rows.
+        """
+        boxes = boxes.astype(np.float64)
+        h = np.minimum(self.y2, boxes[:, 2:3])
+        h -= np.maximum(self.y1, boxes[:, 0:1])
+        np.maximum(h, 0, out=h)
+        intersection = np.minimum(self.x2, boxes[:, 3:4])
+        intersection -= np.maximum(self.x1, boxes[:, 1:2])
+        np.maximum(intersection, 0, out=intersection)
+        intersection *= h
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        union = areas[:, None] + self.areas
+        union -= intersection
+        intersection /= union
+        return intersection.T
+    
+    def deltas(self, ix, boxes):
+        """Returns the refinements [len(ix), (dy, dx, log(dh), log(dw))] that 
+        transform the anchors ix into boxes [len(ix), (y1, x1, y2, x2)]."""
+        h = boxes[:, 2] - boxes[:, 0]
+        w = boxes[:, 3] - boxes[:, 1]
+        center_y = boxes[:, 0] + 0.5 * h
+        center_x = boxes[:, 1] + 0.5 * w
+        return np.stack([(center_y - self.center_y[ix]) / self.heights[ix],
+                         (center_x - self.center_x[ix]) / self.widths[ix],
+                         np.log(h / self.heights[ix]),
+                         np.log(w / self.widths[ix])], axis=1)
+    
+def build_rpn_targets(anchors, gt_class_ids, gt_boxes, config):
+    """Vectorized modellib.build_rpn_targets, returning the same targets for
+    the same random state.
+    anchors: AnchorGeometry
+    gt_class_ids: [num_gt_boxes] Integer class IDs, negative for crowds.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    Returns:
+    rpn_match: [N] (int32) 1 = positive anchor, -1 = negative anchor, 0 = neutral
+    rpn_bbox: [RPN_TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))] deltas
+        of the positive anchors, normalized by RPN_BBOX_STD_DEV.
+    """
+    rpn_match = np.zeros([len(anchors)], dtype=np.int32)
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+
+    # Exclude anchors on COCO crowds (negative class ID) from training
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        crowd_boxes = gt_boxes[crowd_ix]
+        gt_class_ids = gt_class_ids[non_crowd_ix]
+        gt_boxes = gt_boxes[non_crowd_ix]
+        no_crowd_bool = np.amax(anchors.overlaps(crowd_boxes), axis=1) < 0.001
+    else:
+        no_crowd_bool = np.ones([len(anchors)], dtype=bool)
+
+    # Match anchors to GT boxes, see modellib.build_rpn_targets
+    overlaps = anchors.overlaps(gt_boxes)
+    anchor_iou_argmax = np.argmax(overlaps, axis=1)
+    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    gt_iou_argmax = np.argmax(overlaps, axis=0)
+    rpn_match[gt_iou_argmax] = 1
+    rpn_match[anchor_iou_max >= 0.7] = 1
+
+    # Subsample to balance positive and negative anchors
+    ids = np.where(rpn_match == 1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
+                        np.sum(rpn_match == 1))
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+
+    # Deltas of all positive anchors to their closest gt box at once
+    ids = np.where(rpn_match == 1)[0]
+    rpn_bbox[:ids.shape[0]] = anchors.deltas(ids, gt_boxes[anchor_iou_argmax[ids]]) / config.RPN_BBOX_STD_DEV
+    return rpn_match, rpn_bbox
 
 def siamese_data_generator(dataset, config, shuffle=True, augmentation=imgaug.augmenters.Fliplr(0.5), random_rois=0,
-                   batch_size=1, detection_targets=False, diverse=0):
+                   batch_size=1, detection_targets=False, diverse=0, profiler=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
     dataset: The Dataset object to pick data from
@@ -91,6 +890,7 @@ def siamese_data_generator(dataset, config, shuffle=True, augmentation=imgaug.au
         in trainig detection targets are generated by DetectionTargetLayer.
     diverse: Float in [0,1] indicatiing probability to draw a target
         from any random class instead of one from the image classes
+    profiler: Optional. DataProfiler that records the time of every stage
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The containtes
     of the lists differs depending on the received arguments:
@@ -107,6 +907,7 @@ def siamese_data_generator(dataset, config, shuffle=True, augmentation=imgaug.au
     outputs list: Usually empty in regular training. But if detection_targets
         is True then the outputs list contains target class_ids, bbox deltas,
         and masks.
+    For training with multiprocessing workers use SiameseDataSequence instead.
     """
     b = 0  # batch item index
     image_index = -1
@@ -115,12 +916,7 @@ def siamese_data_generator(dataset, config, shuffle=True, augmentation=imgaug.au
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
-    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchors = get_anchor_geometry(config)
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -130,160 +926,28 @@ def siamese_data_generator(dataset, config, shuffle=True, augmentation=imgaug.au
             if shuffle and image_index == 0:
                 np.random.shuffle(image_ids)
 
-            # Get GT bounding boxes and masks for image.
             image_id = image_ids[image_index]
-            image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                modellib.load_image_gt(dataset, config, image_id, augmentation=augmentation,
-                              use_mini_mask=config.USE_MINI_MASK)
-
-            # Replace class ids with foreground/background info if binary
-            # class option is chosen
-            # if binary_classes == True:
-            #    gt_class_ids = np.minimum(gt_class_ids, 1)
-
-            # Skip images that have no instances. This can happen in cases
-            # where we train on a subset of classes and the image doesn't
-            # have any of the classes we care about.
-            if not np.any(gt_class_ids > 0):
-                continue
-                
-#             print(gt_class_ids)
-
-            # Use only positive class_ids
-            categories = np.unique(gt_class_ids)
-            _idx = categories > 0
-            categories = categories[_idx]
-            # Use only active classes
-            active_categories = []
-            for c in categories:
-                if any(c == dataset.ACTIVE_CLASSES):
-                    active_categories.append(c)
-            
-            # Skiop image if it contains no instance of any active class    
-            if not np.any(np.array(active_categories) > 0):
+            with _profile(profiler, "sample"):
+                sample = load_siamese_sample(dataset, config, image_id, anchors, augmentation=augmentation,
+                                             random_rois=random_rois, detection_targets=detection_targets,
+                                             profiler=profiler)
+            if sample is None:
                 continue
-            # Randomly select category
-            category = np.random.choice(active_categories)
-                
-            # Generate siamese target crop
-            if not config.NUM_TARGETS:
-                config.NUM_TARGETS = 1
-            targets = []
-            for i in range(config.NUM_TARGETS):
-                targets.append(get_one_target(category, dataset, config, augmentation=augmentation))
-#             target = np.stack(target, axis=0)
-                    
-#             print(target_class_id)
-            target_class_id = category
-            target_class_ids = np.array([target_class_id])
-            
-            idx = gt_class_ids == target_class_id
-            siamese_class_ids = idx.astype('int8')
-#             print(idx)
-#             print(gt_boxes.shape, gt_masks.shape)
-            siamese_class_ids = siamese_class_ids[idx]
-            gt_class_ids = gt_class_ids[idx]
-            gt_boxes = gt_boxes[idx,:]
-            gt_masks = gt_masks[:,:,idx]
-            image_meta = image_meta[:14]
-#             print(gt_boxes.shape, gt_masks.shape)
-
-            # RPN Targets
-            rpn_match, rpn_bbox = modellib.build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
-
-            # Mask R-CNN Targets
-            if random_rois:
-                rpn_rois = modellib.generate_random_rois(
-                    image.shape, random_rois, gt_class_ids, gt_boxes)
-                if detection_targets:
-                    rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
-                        modellib.build_detection_targets(
-                            rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
-
-            # Init batch arrays
-            if b == 0:
-                batch_image_meta = np.zeros(
-                    (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
-                batch_rpn_match = np.zeros(
-                    [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
-                batch_rpn_bbox = np.zeros(
-                    [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
-                batch_gt_class_ids = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
-                batch_gt_boxes = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-                batch_targets = np.zeros(
-                    (batch_size, config.NUM_TARGETS) + targets[0].shape, dtype=np.float32)
-#                 batch_target_class_ids = np.zeros(
-#                     (batch_size, config.MAX_TARGET_INSTANCES), dtype=np.int32)
-                if config.USE_MINI_MASK:
-                    batch_gt_masks = np.zeros((batch_size, config.MINI_MASK_SHAPE[0], config.MINI_MASK_SHAPE[1],
-                                               config.MAX_GT_INSTANCES))
-                else:
-                    batch_gt_masks = np.zeros(
-                        (batch_size, image.shape[0], image.shape[1], config.MAX_GT_INSTANCES))
-                if random_rois:
-                    batch_rpn_rois = np.zeros(
-                        (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
-                    if detection_targets:
-                        batch_rois = np.zeros(
-                            (batch_size,) + rois.shape, dtype=rois.dtype)
-                        batch_mrcnn_class_ids = np.zeros(
-                            (batch_size,) + mrcnn_class_ids.shape, dtype=mrcnn_class_ids.dtype)
-                        batch_mrcnn_bbox = np.zeros(
-                            (batch_size,) + mrcnn_bbox.shape, dtype=mrcnn_bbox.dtype)
-                        batch_mrcnn_mask = np.zeros(
-                            (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
-
-            # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                siamese_class_ids = siamese_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
-                
 
-            # Add to batch
-            batch_image_meta[b] = image_meta
-            batch_rpn_match[b] = rpn_match[:, np.newaxis]
-            batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = modellib.mold_image(image.astype(np.float32), config)
-            batch_targets[b] = np.stack([modellib.mold_image(target.astype(np.float32), config) for target in targets], axis=0)
-            batch_gt_class_ids[b, :siamese_class_ids.shape[0]] = siamese_class_ids
-#             batch_target_class_ids[b, :target_class_ids.shape[0]] = target_class_ids
-            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
-            if random_rois:
-                batch_rpn_rois[b] = rpn_rois
-                if detection_targets:
-                    batch_rois[b] = rois
-                    batch_mrcnn_class_ids[b] = mrcnn_class_ids
-                    batch_mrcnn_bbox[b] = mrcnn_bbox
-                    batch_mrcnn_mask[b] = mrcnn_mask
+            with _profile(profiler, "batch"):
+                # Init batch arrays
+                if b == 0:
+                    batch = allocate_siamese_batch(sample, config, batch_size, anchors)
+
+                # Add to batch
+                add_siamese_sample(batch, b, sample, config)
             b += 1
 
             # Batch full?
             if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_targets, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
-                outputs = []
-
-                if random_rois:
-                    inputs.extend([batch_rpn_rois])
-                    if detection_targets:
-                        inputs.extend([batch_rois])
-                        # Keras requires that output and targets have the same number of dimensions
-                        batch_mrcnn_class_ids = np.expand_dims(
-                            batch_mrcnn_class_ids, -1)
-                        outputs.extend(
-                            [batch_mrcnn_class_ids, batch_mrcnn_bbox, batch_mrcnn_mask])
-
-                yield inputs, outputs
+                if profiler is not None:
+                    profiler.maybe_log()
+                yield siamese_batch_inputs(batch)
 
                 # start a new batch
                 b = 0
@@ -293,13 +957,497 @@ def siamese_data_generator(dataset, config, shuffle=True, augmentation=imgaug.au
             # Log it and skip the image
             modellib.logging.exception("Error processing image {}".format(
                 dataset.image_info[image_id]))
+            _count(profiler, "errors")
             error_count += 1
             if error_count > 5:
                 raise
                 
-                
+class SiameseDataSequence(keras.utils.Sequence):
+    """keras.utils.Sequence version of siamese_data_generator that is safe to 
+    use with multiprocessing workers. Returns the same inputs and outputs.
+    
+    Batch idx of epoch e is the step e * steps + idx of one endless stream of 
+    samples. That stream walks through seeded permutations of the images, so 
+    every step owns its own shard of images no matter which worker loads it. 
+    While loading a batch the numpy, random and imgaug RNGs are seeded from
+    (seed, step), so batches are reproducible and differ between workers.
+    Their previous states are restored afterwards, loading a batch doesn't
+    change the random streams of the caller.
+    Images that fail to load or contain no active class are replaced by 
+    random images drawn with the same seeded RNG.
+    
+    steps: Number of batches per epoch. Defaults to one pass over the images.
+    seed: Optional. Seed of the sample stream. Drawn randomly if not given.
+    profiler: Optional. DataProfiler, see siamese_data_generator. Workers of
+        a SiameseDataLoader record into their own copies.
+    Keras calls on_epoch_end in the main process and restarts the workers 
+    with the updated sequence, see keras.utils.OrderedEnqueuer.
+    """
+    
+    def __init__(self, dataset, config, shuffle=True, augmentation=imgaug.augmenters.Fliplr(0.5), random_rois=0,
+                 batch_size=1, detection_targets=False, steps=None, seed=None, profiler=None):
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.augmentation = augmentation
+        self.random_rois = random_rois
+        self.batch_size = batch_size
+        self.detection_targets = detection_targets
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.epoch = 0
+        self.error_count = 0
+        self.profiler = profiler
+        self.anchors = get_anchor_geometry(config)
+        
+        # Skip images without active classes up front if the dataset is indexed
+        image_ids = np.copy(dataset.image_ids)
+        image_category_index = getattr(dataset, 'image_category_index', None)
+        if image_category_index is not None:
+            active = np.zeros([dataset.num_classes], dtype=np.bool)
+            active[np.array(dataset.ACTIVE_CLASSES, dtype=np.int32)] = True
+            image_ids = np.array([i for i in image_ids if np.any(active[image_category_index[i]])], 
+                                 dtype=image_ids.dtype)
+        self.image_ids = image_ids
+        self.steps = steps or max(1, len(self.image_ids) // batch_size)
+        self._permutation = (None, None)
+        
+    def __len__(self):
+        return self.steps
+    
+    def on_epoch_end(self):
+        self.epoch += 1
+        
+    def permutation(self, round):
+        """Returns the order of the images in the given pass over the dataset."""
+        if self._permutation[0] != round:
+            if self.shuffle:
+                order = np.random.RandomState([self.seed, 0, round]).permutation(len(self.image_ids))
+            else:
+                order = np.arange(len(self.image_ids))
+            self._permutation = (round, order)
+        return self._permutation[1]
+    
+    def __getitem__(self, idx):
+        return siamese_batch_inputs(self.load_batch(idx))
+    
+    def __iter__(self):
+        """Endless iterator over the batches of all epochs. fit_generator uses 
+        it with workers=0 but keras.utils.Sequence.__iter__ never calls 
+        on_epoch_end, which would repeat the batches of the first epoch."""
+        while True:
+            for idx in range(len(self)):
+                yield self[idx]
+            self.on_epoch_end()
+    
+    def load_batch(self, idx, batch=None):
+        """Loads batch idx of the current epoch into a dict of batch arrays
+        (see allocate_siamese_batch). batch: Optional. Arrays to fill in place."""
+        step = self.epoch * self.steps + idx
+        # Seed all RNGs used by target sampling and augmentation
+        with _SeededRandomState([self.seed, 1, step]) as rng:
+            return self._load_batch(step, rng, batch)
+        
+    def _load_batch(self, step, rng, batch):
+        position = step * self.batch_size
+        b = 0
+        image_id = self.image_ids[self.permutation(position // len(self.image_ids))[position % len(self.image_ids)]]
+        while b < self.batch_size:
+            try:
+                with _profile(self.profiler, "sample"):
+                    sample = load_siamese_sample(self.dataset, self.config, image_id, self.anchors, 
+                                                 augmentation=self.augmentation, random_rois=self.random_rois,
+                                                 detection_targets=self.detection_targets, 
+                                                 profiler=self.profiler)
+            except KeyboardInterrupt:
+                raise
+            except:
+                # Log it and replace the image
+                modellib.logging.exception("Error processing image {}".format(
+                    self.dataset.image_info[image_id]))
+                _count(self.profiler, "errors")
+                self.error_count += 1
+                if self.error_count > 5:
+                    raise
+                sample = None
+            if sample is None:
+                image_id = self.image_ids[rng.randint(len(self.image_ids))]
+                continue
+            with _profile(self.profiler, "batch"):
+                if batch is None:
+                    batch = allocate_siamese_batch(sample, self.config, self.batch_size, self.anchors)
+                add_siamese_sample(batch, b, sample, self.config)
+            b += 1
+            position += 1
+            image_id = self.image_ids[self.permutation(position // len(self.image_ids))[position % len(self.image_ids)]]
+        if self.profiler is not None:
+            self.profiler.maybe_log()
+        return batch
+    
+# Sequence and batch slots of the SiameseDataLoader worker process
+_loader_worker = {}
+
+def _init_siamese_loader_worker(sequence, buffer, layout, slot_size, slots):
+    _loader_worker['sequence'] = sequence
+    _loader_worker['slots'] = SiameseDataLoader.slot_views(buffer, layout, slot_size, slots)
+    
+def _load_siamese_loader_batch(epoch, idx, slot):
+    sequence = _loader_worker['sequence']
+    sequence.epoch = epoch
+    sequence.load_batch(idx, batch=_loader_worker['slots'][slot])
+    return slot
+    
+class SiameseDataLoader(object):
+    """Loads the batches of a SiameseDataSequence with a pool of worker processes
+    into a ring of preallocated batch slots in shared memory. Workers fill the 
+    slots in place and only send back the slot number, so no batch data is 
+    pickled between processes. Iterate it like siamese_data_generator and pass 
+    it to fit_generator with workers=0.
+    
+    A yielded batch stays valid until the next one is requested, then its slot
+    is reused. Every batch is seeded from its epoch and index alone (see 
+    SiameseDataSequence), so the batches don't depend on which worker loads 
+    them and match those of the sequence. The first batch is loaded in the 
+    calling process to probe the batch layout, its RNGs are left untouched.
+    sequence: The SiameseDataSequence to load batches of
+    workers: Number of worker processes
+    max_queue_size: Number of batches to load ahead. The ring has one more slot.
+    """
+    
+    def __init__(self, sequence, workers=1, max_queue_size=10):
+        self.sequence = sequence
+        self.num_slots = max_queue_size + 1
+        # Probe the batch layout with the first batch
+        probe = sequence.load_batch(0)
+        self.layout = []
+        size = 0
+        for name in sorted(probe.keys()):
+            array = probe[name]
+            self.layout.append((name, array.shape, array.dtype.str, size))
+            # Keep every array 64 byte aligned
+            size += (array.nbytes + 63) // 64 * 64
+        self.slot_size = size
+        self.buffer = multiprocessing.RawArray('b', max(1, size * self.num_slots))
+        self.slots = SiameseDataLoader.slot_views(self.buffer, self.layout, self.slot_size, self.num_slots)
+        self.pool = multiprocessing.Pool(workers, initializer=_init_siamese_loader_worker,
+                                         initargs=(sequence, self.buffer, self.layout, self.slot_size, 
+                                                   self.num_slots))
+        # The probe is batch 0 of the current epoch, hand it out instead of loading it again
+        for name, array in probe.items():
+            self.slots[0][name][...] = array
+        self.free_slots = list(range(1, self.num_slots))
+        self.pending = collections.deque([0])
+        self.consumed_slot = None
+        self.epoch = sequence.epoch
+        self.next_index = 0
+        self._advance()
+        
+    @staticmethod
+    def slot_views(buffer, layout, slot_size, slots):
+        """Returns one dict of batch arrays per slot, all views into buffer.
+        layout: [(name, shape, dtype, offset in the slot)]"""
+        memory = np.frombuffer(buffer, dtype=np.uint8)
+        views = []
+        for slot in range(slots):
+            start = slot * slot_size
+            views.append({name: memory[start + offset:start + offset + int(np.prod(shape)) * np.dtype(dtype).itemsize]
+                                .view(dtype).reshape(shape)
+                          for name, shape, dtype, offset in layout})
+        return views
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        # The consumer is done with the previous batch
+        if self.consumed_slot is not None:
+            self.free_slots.append(self.consumed_slot)
+            self.consumed_slot = None
+        # Keep all free slots busy
+        while self.free_slots:
+            slot = self.free_slots.pop(0)
+            self.pending.append(self.pool.apply_async(_load_siamese_loader_batch, 
+                                                      (self.epoch, self.next_index, slot)))
+            self._advance()
+        # Slot numbers are already loaded batches
+        result = self.pending.popleft()
+        self.consumed_slot = result if isinstance(result, int) else result.get()
+        return siamese_batch_inputs(self.slots[self.consumed_slot])
+    
+    next = __next__
+    
+    def _advance(self):
+        self.next_index += 1
+        if self.next_index >= len(self.sequence):
+            self.next_index = 0
+            self.epoch += 1
+    
+    def close(self):
+        """Stops the worker processes."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            
+    def __del__(self):
+        self.close()
+    
+
 ### Dataset Utils ###
 
+class CocoAnnotationCache(object):
+    """Compiled, binary form of a COCO instances_*.json annotation file.
+
+    All annotations are kept as flat numpy arrays (ids, image rows, category
+    ids, crowd flags, areas, boxes) plus one memory-mapped byte array with the
+    compressed RLE of every segmentation. The cache lives in two files,
+    <path>.npz and <path>_rle.npy, and is built once from the json with
+    pycocotools. Afterwards no process needs to parse the json or keep its
+    dict tree in memory; annotation dicts are only created on access (see
+    CocoAnnotationList).
+
+    Implements the part of the pycocotools COCO API that CocoDataset.load_coco
+    uses (getCatIds, loadCats, getImgIds, getAnnIds, loadAnns, imgs) with
+    identical results and can be passed to it as coco object.
+    """
+    # Bump when the layout of the cache files changes
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        arrays = np.load(path + ".npz")
+        self.image_ids = arrays["image_ids"]
+        self.image_file_names = arrays["image_file_names"]
+        self.image_shapes = arrays["image_shapes"]
+        self.category_ids = arrays["category_ids"]
+        self.category_names = arrays["category_names"]
+        self.category_supercategories = arrays["category_supercategories"]
+        # Annotations in file order [annotation count]
+        self.annotation_ids = arrays["annotation_ids"]
+        self.annotation_image_rows = arrays["annotation_image_rows"]
+        self.annotation_category_ids = arrays["annotation_category_ids"]
+        self.annotation_iscrowd = arrays["annotation_iscrowd"]
+        self.annotation_areas = arrays["annotation_areas"]
+        self.annotation_bboxes = arrays["annotation_bboxes"]
+        self.rle_sizes = arrays["rle_sizes"]
+        self.rle_offsets = arrays["rle_offsets"]
+        # annotation_order[image_offsets[r]:image_offsets[r+1]] are the
+        # annotations of image row r in file order
+        self.annotation_order = arrays["annotation_order"]
+        self.image_offsets = arrays["image_offsets"]
+        self.rle_counts = np.load(path + "_rle.npy", mmap_mode="r")
+        # Sorts annotation ids to look up annotation rows, built on first use
+        self.annotation_id_order = None
+
+        self.image_rows = {image_id: row for row, image_id in enumerate(self.image_ids.tolist())}
+        self.imgs = {image_id: {"id": image_id,
+                                "file_name": str(self.image_file_names[row]),
+                                "height": int(self.image_shapes[row, 0]),
+                                "width": int(self.image_shapes[row, 1])}
+                     for image_id, row in self.image_rows.items()}
+
+    def __getstate__(self):
+        # Reopen from disk instead of pickling the arrays
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @staticmethod
+    def cache_path(annotation_file, cache_dir):
+        """Returns the cache path (without extension) for an annotation file.
+        The key covers the absolute path, mtime and size of the file.
+        """
+        annotation_file = os.path.abspath(annotation_file)
+        stat = os.stat(annotation_file)
+        key = hashlib.md5("{}:{}:{}:{}".format(
+            annotation_file, stat.st_mtime, stat.st_size, CocoAnnotationCache.VERSION).encode())
+        name = os.path.splitext(os.path.basename(annotation_file))[0]
+        return os.path.join(cache_dir, "{}_{}".format(name, key.hexdigest()))
+
+    @classmethod
+    def open(cls, annotation_file, cache_dir):
+        """Opens the cache of an annotation file, building it first if needed."""
+        path = cls.cache_path(annotation_file, cache_dir)
+        if not os.path.exists(path + ".npz"):
+            cls.build(annotation_file, path)
+        return cls(path)
+
+    @classmethod
+    def build(cls, annotation_file, path):
+        """Parses annotation_file with pycocotools and writes the cache to path."""
+        coco = COCO(annotation_file)
+        images = list(coco.imgs.values())
+        image_ids = np.array([image["id"] for image in images], dtype=np.int64)
+        image_rows = {image_id: row for row, image_id in enumerate(image_ids.tolist())}
+        categories = coco.dataset.get("categories", [])
+        annotations = coco.dataset.get("annotations", [])
+
+        # Convert every segmentation to compressed RLE
+        counts = []
+        rle_sizes = np.zeros([len(annotations), 2], dtype=np.int32)
+        for i, annotation in enumerate(annotations):
+            image = coco.imgs[annotation["image_id"]]
+            segm = annotation["segmentation"]
+            if isinstance(segm, list):
+                rle = maskUtils.merge(maskUtils.frPyObjects(segm, image["height"], image["width"]))
+            elif isinstance(segm["counts"], list):
+                rle = maskUtils.frPyObjects(segm, image["height"], image["width"])
+            else:
+                rle = segm
+            rle_counts = rle["counts"]
+            if not isinstance(rle_counts, bytes):
+                rle_counts = rle_counts.encode("ascii")
+            counts.append(rle_counts)
+            rle_sizes[i] = rle["size"]
+        rle_offsets = np.concatenate(
+            [[0], np.cumsum([len(c) for c in counts], dtype=np.int64)]).astype(np.int64)
+
+        annotation_image_rows = np.array([image_rows[a["image_id"]] for a in annotations], dtype=np.int32)
+        annotation_order = np.argsort(annotation_image_rows, kind="mergesort").astype(np.int32)
+        image_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(annotation_image_rows, minlength=len(images)))]).astype(np.int64)
+
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to temporary files first so concurrent readers never see partial
+        # caches. The npz is written last, its presence marks a complete cache.
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        np.save(tmp_path + "_rle.npy", np.frombuffer(b"".join(counts), dtype=np.uint8))
+        os.replace(tmp_path + "_rle.npy", path + "_rle.npy")
+        np.savez(tmp_path + ".npz",
+                 image_ids=image_ids,
+                 image_file_names=np.array([image["file_name"] for image in images], dtype=np.str_),
+                 image_shapes=np.array([[image["height"], image["width"]] for image in images],
+                                       dtype=np.int32).reshape([-1, 2]),
+                 category_ids=np.array([c["id"] for c in categories], dtype=np.int64),
+                 category_names=np.array([c["name"] for c in categories], dtype=np.str_),
+                 category_supercategories=np.array([c.get("supercategory", "") for c in categories],
+                                                   dtype=np.str_),
+                 annotation_ids=np.array([a["id"] for a in annotations], dtype=np.int64),
+                 annotation_image_rows=annotation_image_rows,
+                 annotation_category_ids=np.array([a["category_id"] for a in annotations], dtype=np.int64),
+                 annotation_iscrowd=np.array([a.get("iscrowd", 0) for a in annotations], dtype=np.uint8),
+                 annotation_areas=np.array([a["area"] for a in annotations], dtype=np.float64),
+                 annotation_bboxes=np.array([a["bbox"] for a in annotations],
+                                            dtype=np.float64).reshape([-1, 4]),
+                 rle_sizes=rle_sizes,
+                 rle_offsets=rle_offsets,
+                 annotation_order=annotation_order,
+                 image_offsets=image_offsets)
+        os.replace(tmp_path + ".npz", path + ".npz")
+
+    def getCatIds(self):
+        """Same as COCO.getCatIds() without filters."""
+        return self.category_ids.tolist()
+
+    def loadCats(self, ids):
+        """Same as COCO.loadCats(ids)."""
+        ids = ids if isinstance(ids, (list, tuple, np.ndarray)) else [ids]
+        rows = {category_id: row for row, category_id in enumerate(self.category_ids.tolist())}
+        return [{"id": int(i),
+                 "name": str(self.category_names[rows[i]]),
+                 "supercategory": str(self.category_supercategories[rows[i]])} for i in ids]
+
+    def getImgIds(self, catIds=[]):
+        """Same ids in the same order as COCO.getImgIds(catIds=catIds)."""
+        if len(catIds) == 0:
+            return self.image_ids.tolist()
+        ids = None
+        for category_id in catIds:
+            rows = self.annotation_image_rows[self.annotation_category_ids == category_id]
+            # Insert in file order, like COCO.catToImgs, so set iteration order matches
+            category_image_ids = set(self.image_ids[rows].tolist())
+            ids = category_image_ids if ids is None else ids & category_image_ids
+        return list(ids)
+
+    def getAnnIds(self, imgIds=[], catIds=[], iscrowd=None):
+        """Same ids in the same order as COCO.getAnnIds(imgIds, catIds, iscrowd=iscrowd)."""
+        imgIds = imgIds if isinstance(imgIds, (list, tuple, np.ndarray)) else [imgIds]
+        if len(imgIds) == 0:
+            rows = np.arange(self.annotation_ids.shape[0])
+        else:
+            rows = np.concatenate([[]] + [self.annotation_order[self.image_offsets[r]:self.image_offsets[r + 1]]
+                                          for r in (self.image_rows[i] for i in imgIds)]).astype(np.int64)
+        if len(catIds) > 0:
+            rows = rows[np.isin(self.annotation_category_ids[rows], catIds)]
+        if iscrowd is not None:
+            rows = rows[self.annotation_iscrowd[rows] == iscrowd]
+        return self.annotation_ids[rows].tolist()
+
+    def loadAnns(self, ids):
+        """Lazy equivalent of COCO.loadAnns(ids). Returns a CocoAnnotationList."""
+        ids = np.array(ids if isinstance(ids, (list, tuple, np.ndarray)) else [ids], dtype=np.int64)
+        if self.annotation_id_order is None:
+            self.annotation_id_order = np.argsort(self.annotation_ids, kind="mergesort")
+        rows = self.annotation_id_order[np.searchsorted(self.annotation_ids[self.annotation_id_order], ids)]
+        return CocoAnnotationList(self, rows)
+
+    def annotation(self, row):
+        """Returns the annotation dict of an annotation row. The segmentation
+        is given as compressed RLE."""
+        start, end = self.rle_offsets[row], self.rle_offsets[row + 1]
+        return {"id": int(self.annotation_ids[row]),
+                "image_id": int(self.image_ids[self.annotation_image_rows[row]]),
+                "category_id": int(self.annotation_category_ids[row]),
+                "iscrowd": int(self.annotation_iscrowd[row]),
+                "area": float(self.annotation_areas[row]),
+                "bbox": self.annotation_bboxes[row].tolist(),
+                "segmentation": {"size": self.rle_sizes[row].tolist(),
+                                 "counts": self.rle_counts[start:end].tobytes()}}
+
+
+class CocoAnnotationList(object):
+    """Read-only list of the annotations of one image in a CocoAnnotationCache.
+    Annotation dicts are created on access.
+    """
+
+    def __init__(self, cache, rows):
+        self.cache = cache
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.cache.annotation(row) for row in self.rows[index]]
+        return self.cache.annotation(self.rows[index])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.cache.annotation(row)
+
+    @staticmethod
+    def table(annotation_lists):
+        """Flattens the annotations of several CocoAnnotationLists without
+        creating any dicts.
+        Returns [annotation count, (list index, id, category_id, iscrowd, area,
+        x, y, w, h)]
+        """
+        if len(annotation_lists) == 0:
+            return np.zeros([0, 9], dtype=np.float64)
+        cache = annotation_lists[0].cache
+        rows = np.concatenate([a.rows for a in annotation_lists]).astype(np.int64)
+        list_index = np.repeat(np.arange(len(annotation_lists)), [len(a) for a in annotation_lists])
+        return np.concatenate([np.stack([list_index,
+                                         cache.annotation_ids[rows],
+                                         cache.annotation_category_ids[rows],
+                                         cache.annotation_iscrowd[rows],
+                                         cache.annotation_areas[rows]], axis=1),
+                               cache.annotation_bboxes[rows]], axis=1).astype(np.float64)
+
+# Record of one annotated instance in IndexedCocoDataset.category_instance_index
+# image_id: dataset internal image id
+# annotation_id: source (COCO) annotation id
+# bbox: (y1, x1, y2, x2) in original image pixels
+# area: annotated segmentation area in original image pixels
+# image_shape: (height, width) of the original image
+INSTANCE_INDEX_DTYPE = np.dtype([('image_id', np.int32), 
+                                 ('annotation_id', np.int64), 
+                                 ('bbox', np.float32, (4,)), 
+                                 ('area', np.float32), 
+                                 ('image_shape', np.int32, (2,))])
+
 class IndexedCocoDataset(coco.CocoDataset):
     
     def __init__(self):
@@ -315,58 +1463,516 @@ class IndexedCocoDataset(coco.CocoDataset):
             active_classes = [int(x.strip()) for x in content]
         self.active_classes = list(active_classes)
         
-    def get_class_ids(self, active_classes, dataset_dir, subset, year):
-        coco = COCO("{}/annotations/instances_{}{}.json".format(dataset_dir, subset, year))
-        class_ids = sorted(list(filter(lambda c: c in coco.getCatIds(), self.active_classes)))
+    def load_target_crop_store(self, path):
+        """Reads targets from a TargetCropStore built at path whenever the
+        target size of the config matches the stored one."""
+        self.target_crop_store = TargetCropStore(path)
+        
+    def get_class_ids(self, active_classes, dataset_dir, subset, year, annotation_cache_dir=None):
+        annotation_file = "{}/annotations/instances_{}{}.json".format(dataset_dir, subset, year)
+        if annotation_cache_dir:
+            coco_object = CocoAnnotationCache.open(annotation_file, annotation_cache_dir)
+        else:
+            coco_object = COCO(annotation_file)
+        class_ids = sorted(list(filter(lambda c: c in coco_object.getCatIds(), self.active_classes)))
         return class_ids
 
         self.class_ids_with_holes = class_ids
     
-    def build_indices(self):
-
-        self.image_category_index = IndexedCocoDataset._build_image_category_index(self)
-        self.category_image_index = IndexedCocoDataset._build_category_image_index(self.image_category_index)
-
-    def _build_image_category_index(dataset):
-
-        image_category_index = []
-        for im in range(len(dataset.image_info)):
-            # List all classes in an image
-            coco_class_ids = list(\
-                                  np.unique(\
-                                            [dataset.image_info[im]['annotations'][i]['category_id']\
-                                             for i in range(len(dataset.image_info[im]['annotations']))]\
-                                           )\
-                                 )
-            # Map 91 class IDs 81 to Mask-RCNN model type IDs
-            class_ids = [dataset.map_source_class_id("coco.{}".format(coco_class_ids[k]))\
-                         for k in range(len(coco_class_ids))]
-            # Put list together
-            image_category_index.append(class_ids)
-
-        return image_category_index
-
-    def _build_category_image_index(image_category_index):
-
-        category_image_index = []
-        # Loop through all 81 Mask-RCNN classes/categories
-        for category in range(max(image_category_index)[0]+1):
-            # Find all images corresponding to the selected class/category 
-            images_per_category = np.where(\
-                [any(image_category_index[i][j] == category\
-                 for j in range(len(image_category_index[i])))\
-                 for i in range(len(image_category_index))])[0]
-            # Put list together
-            category_image_index.append(images_per_category)
-
-        return category_image_index
+    def load_coco(self, dataset_dir, subset, year=coco.DEFAULT_DATASET_YEAR, class_ids=None,
+                  class_map=None, return_coco=False, auto_download=False, subsubset='train',
+                  annotation_cache_dir=None):
+        """Loads a subset of the COCO dataset, see CocoDataset.load_coco.
+        Additionally remembers the annotation file to key the index cache.
+        
+        annotation_cache_dir: Optional. Directory of compiled annotation caches
+            (see CocoAnnotationCache). The cache is built on first use, later
+            calls don't parse the json. Image annotations are then loaded lazily.
+            With return_coco the json is still parsed for the returned COCO object.
+        """
+        self.annotation_path = "{}/annotations/instances_{}{}.json".format(dataset_dir, subset, year)
+        coco_object = None
+        if annotation_cache_dir:
+            if auto_download is True:
+                self.auto_download(dataset_dir, subset, year)
+            coco_object = CocoAnnotationCache.open(self.annotation_path, annotation_cache_dir)
+        result = super(IndexedCocoDataset, self).load_coco(dataset_dir, subset, year=year, class_ids=class_ids,
+                                                           class_map=class_map, return_coco=return_coco, 
+                                                           auto_download=auto_download, subsubset=subsubset,
+                                                           coco=coco_object)
+        if return_coco and coco_object is not None:
+            return COCO(self.annotation_path)
+        return result
+    
+    def image_classes(self, image_id):
+        """Returns the sorted class ids of the non-crowd instances in an image.
+        Reads only the annotations (image_category_index once build_indices
+        was called), no image or mask is decoded."""
+        image_category_index = getattr(self, 'image_category_index', None)
+        if image_category_index is not None:
+            return image_category_index[image_id]
+        class_ids = [self.class_from_source_map.get("coco.{}".format(a['category_id']), 0)
+                     for a in self.image_info[image_id]['annotations'] if not a['iscrowd']]
+        class_ids = np.unique(np.array(class_ids, dtype=np.int32))
+        return class_ids[class_ids > 0]
+    
+    def build_indices(self, cache_dir=None):
+        """Builds the image <-> category and category -> instance indices in 
+        a single pass over all annotations. Must be called after prepare().
+        
+        The indices are stored as CSR-style numpy arrays:
+        category_image_ids[category_image_offsets[c]:category_image_offsets[c+1]]
+            are the images with at least one (non-crowd) instance of category c
+        image_category_ids[image_category_offsets[i]:image_category_offsets[i+1]]
+            are the categories in image i
+        category_instances[category_instance_offsets[c]:category_instance_offsets[c+1]]
+            are all (non-crowd) instances of category c, see INSTANCE_INDEX_DTYPE
+        category_image_index, image_category_index and category_instance_index
+        are lists of views into these arrays.
+        
+        cache_dir: Optional. Directory to cache the built indices in. The cache 
+            is keyed by the annotation file (path and mtime), the loaded images 
+            and the classes, so restarts only need to load it. Needs the 
+            annotation file, i.e. a dataset loaded with load_coco. Otherwise
+            the indices are built without caching.
+        """
+        cache_path = None
+        if cache_dir is not None and getattr(self, 'annotation_path', None) is None:
+            modellib.log("build_indices: no annotation file to key the cache, "
+                         "load the dataset with load_coco. Building without cache.")
+        elif cache_dir is not None:
+            cache_path = os.path.join(cache_dir, "indices_{}.npz".format(self._index_cache_key()))
+        if cache_path is not None and os.path.exists(cache_path):
+            indices = dict(np.load(cache_path))
+        else:
+            indices = IndexedCocoDataset._build_csr_indices(self)
+            if cache_path is not None:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                # Write to a temporary file first so concurrent readers never see partial caches
+                tmp_path = "{}.{}.tmp.npz".format(cache_path[:-4], os.getpid())
+                np.savez(tmp_path, **indices)
+                os.replace(tmp_path, cache_path)
+        for name, array in indices.items():
+            setattr(self, name, array)
+            
+        self.category_image_index = np.split(self.category_image_ids, self.category_image_offsets[1:-1])
+        self.image_category_index = np.split(self.image_category_ids, self.image_category_offsets[1:-1])
+        self.category_instance_index = np.split(self.category_instances, self.category_instance_offsets[1:-1])
+        
+    def _index_cache_key(self):
+        """Hash identifying the annotation file, the loaded images and classes."""
+        annotation_path = os.path.abspath(self.annotation_path)
+        stat = os.stat(annotation_path)
+        key = hashlib.md5()
+        key.update("{}:{}:{}".format(annotation_path, stat.st_mtime, stat.st_size).encode())
+        key.update(np.array([info['id'] for info in self.image_info], dtype=np.int64).tobytes())
+        key.update(",".join("{}.{}".format(info['source'], info['id']) for info in self.class_info).encode())
+        return key.hexdigest()
+    
+    def _build_csr_indices(dataset):
+        """Single pass over all annotations. Returns a dict of index arrays."""
+        
+        num_images = len(dataset.image_info)
+        num_classes = dataset.num_classes
+        
+        # Flatten all annotations [annotation count]
+        annotation_lists = [info['annotations'] for info in dataset.image_info]
+        if all(isinstance(a, CocoAnnotationList) for a in annotation_lists):
+            # Read straight from the compiled annotation cache
+            annotations = CocoAnnotationList.table(annotation_lists)
+        else:
+            annotations = [(im, a['id'], a['category_id'], a['iscrowd'], a['area']) + tuple(a['bbox'])
+                           for im, anns in enumerate(annotation_lists) for a in anns]
+            annotations = np.array(annotations, dtype=np.float64).reshape([-1, 9])
+        image_ids = annotations[:, 0].astype(np.int32)
+        source_class_ids = annotations[:, 2].astype(np.int64)
+        x, y, w, h = annotations[:, 5], annotations[:, 6], annotations[:, 7], annotations[:, 8]
+        
+        # Map source class IDs (91 for COCO) to internal IDs (81) with a lookup table 
+        # large enough for the ids of both the classes and the annotations
+        max_source_id = max([int(info['id']) for info in dataset.class_info if info['source'] == 'coco'] +
+                            [int(source_class_ids.max()) if source_class_ids.shape[0] else 0])
+        lookup = np.zeros([max_source_id + 1], dtype=np.int32)
+        for info, class_id in zip(dataset.class_info, dataset.class_ids):
+            if info['source'] == 'coco':
+                lookup[info['id']] = class_id
+        class_ids = lookup[source_class_ids]
+        
+        # Skip crowds (they are not used as instances) and unknown classes
+        valid = (annotations[:, 3] == 0) & (class_ids > 0)
+        
+        # Category -> images
+        pairs = np.unique(class_ids[valid].astype(np.int64) * num_images + image_ids[valid])
+        category_image_ids = (pairs % num_images).astype(np.int32)
+        category_image_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(pairs // num_images, minlength=num_classes))]).astype(np.int64)
+        # Image -> categories
+        pairs = np.unique(image_ids[valid].astype(np.int64) * num_classes + class_ids[valid])
+        image_category_ids = (pairs % num_classes).astype(np.int32)
+        image_category_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(pairs // num_classes, minlength=num_images))]).astype(np.int64)
+        
+        # Category -> instances with a box of at least one pixel
+        valid = valid & (w >= 1) & (h >= 1)
+        order = np.argsort(class_ids[valid], kind='mergesort')
+        category_instances = np.zeros([order.shape[0]], dtype=INSTANCE_INDEX_DTYPE)
+        category_instances['image_id'] = image_ids[valid][order]
+        category_instances['annotation_id'] = annotations[valid, 1][order]
+        category_instances['bbox'] = np.stack([y, x, y + h, x + w], axis=1)[valid][order]
+        category_instances['area'] = annotations[valid, 4][order]
+        image_shapes = np.array([[info['height'], info['width']] for info in dataset.image_info], 
+                                dtype=np.int32).reshape([-1, 2])
+        category_instances['image_shape'] = image_shapes[category_instances['image_id']]
+        category_instance_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(class_ids[valid], minlength=num_classes))]).astype(np.int64)
+        
+        return {"category_image_ids": category_image_ids,
+                "category_image_offsets": category_image_offsets,
+                "image_category_ids": image_category_ids,
+                "image_category_offsets": image_category_offsets,
+                "category_instances": category_instances,
+                "category_instance_offsets": category_instance_offsets}
 
     
 ### Evaluation ###
 
+class EpisodeTable(object):
+    """Fixed one-shot evaluation episodes: a query image, a category in it 
+    and NUM_TARGETS target instances of that category. Drawn once from a seed
+    and saved, so evaluations are reproducible, can be split across workers
+    and read the same target crops (see TargetCropStore) on every run.
+    
+    All ids are source (COCO) ids, so a table stays valid for any dataset 
+    loaded from the same annotations.
+    image_ids: [E] query image ids
+    categories: [E] source category ids
+    target_image_ids, target_annotation_ids: [E, K] ids of the targets
+    """
+    
+    def __init__(self, image_ids, categories, target_image_ids, target_annotation_ids, seed=None):
+        self.image_ids = np.asarray(image_ids, dtype=np.int64).reshape([-1])
+        self.categories = np.asarray(categories, dtype=np.int64).reshape([-1])
+        num_targets = np.shape(target_image_ids)[-1] if np.size(target_image_ids) else 0
+        self.target_image_ids = np.asarray(target_image_ids, dtype=np.int64).reshape([-1, num_targets])
+        self.target_annotation_ids = np.asarray(target_annotation_ids, dtype=np.int64).reshape([-1, num_targets])
+        self.seed = seed
+        self._instances = None
+        # Episode rows of every query image
+        self._image_episodes = {}
+        for e, image_id in enumerate(self.image_ids.tolist()):
+            self._image_episodes.setdefault(image_id, []).append(e)
+        
+    def __len__(self):
+        return self.image_ids.shape[0]
+    
+    def __getstate__(self):
+        # The instance lookup belongs to the dataset and is rebuilt on demand
+        state = self.__dict__.copy()
+        state['_instances'] = None
+        return state
+    
+    @classmethod
+    def build(cls, dataset, config, seed=0, image_ids=None):
+        """Draws the targets for every active category of every image.
+        dataset: IndexedCocoDataset with build_indices() called
+        image_ids: Optional. Dataset image ids, defaults to all images.
+        """
+        random_state = np.random.RandomState(seed)
+        if image_ids is None:
+            image_ids = dataset.image_ids
+        active = set(int(c) for c in dataset.ACTIVE_CLASSES)
+        rows = []
+        for image_id in image_ids:
+            for category in dataset.image_classes(image_id):
+                if int(category) not in active or dataset.category_instance_index[category].shape[0] == 0:
+                    continue
+                targets = [draw_target_instance(category, dataset, config, random_state=random_state)
+                           for k in range(config.NUM_TARGETS)]
+                rows.append((dataset.image_info[image_id]['id'], 
+                             dataset.class_info[category]['id'],
+                             [dataset.image_info[t['image_id']]['id'] for t in targets],
+                             [t['annotation_id'] for t in targets]))
+        if not rows:
+            return cls([], [], np.zeros([0, config.NUM_TARGETS]), np.zeros([0, config.NUM_TARGETS]), seed=seed)
+        image_ids, categories, target_image_ids, target_annotation_ids = zip(*rows)
+        return cls(image_ids, categories, target_image_ids, target_annotation_ids, seed=seed)
+    
+    def save(self, path):
+        # Write to a temporary file first so concurrent readers never see partial tables
+        tmp_path = "{}.{}.tmp.npz".format(path, os.getpid())
+        np.savez(tmp_path, image_ids=self.image_ids, categories=self.categories,
+                 target_image_ids=self.target_image_ids, 
+                 target_annotation_ids=self.target_annotation_ids,
+                 seed=np.array(-1 if self.seed is None else self.seed))
+        os.replace(tmp_path, path)
+        
+    @classmethod
+    def load(cls, path):
+        table = np.load(path)
+        seed = int(table['seed'])
+        return cls(table['image_ids'], table['categories'], table['target_image_ids'], 
+                   table['target_annotation_ids'], seed=None if seed < 0 else seed)
+    
+    def dataset_image_ids(self, dataset):
+        """Returns the dataset image ids of all query images in table order."""
+        image_index = {info['id']: i for i, info in enumerate(dataset.image_info)}
+        _, first = np.unique(self.image_ids, return_index=True)
+        return [image_index[image_id] for image_id in self.image_ids[np.sort(first)]]
+    
+    def load_targets(self, dataset, config, image_id):
+        """Loads the episodes of one query image.
+        image_id: Dataset image id
+        Returns a list of dataset category ids and a list of [K, h, w, 3] targets.
+        """
+        if self._instances is None or self._instances[0] is not dataset:
+            instances = dataset.category_instances
+            self._instances = (dataset, instances[np.argsort(instances['annotation_id'], kind='mergesort')])
+        instances = self._instances[1]
+        categories = []
+        targets = []
+        for e in self._image_episodes.get(dataset.image_info[image_id]['id'], []):
+            annotation_ids = self.target_annotation_ids[e]
+            ix = np.searchsorted(instances['annotation_id'], annotation_ids)
+            found = ix < instances.shape[0]
+            found[found] = instances['annotation_id'][ix[found]] == annotation_ids[found]
+            missing = annotation_ids[~found]
+            if missing.shape[0] > 0:
+                raise Exception("Target annotations {} of the episode table are not in the dataset. "
+                                "Was the table built from other annotations, classes or crowd "
+                                "filtering?".format(missing.tolist()))
+            categories.append(dataset.map_source_class_id("coco.{}".format(self.categories[e])))
+            targets.append(np.stack([load_target_instance(dataset, config, instance)[0] 
+                                     for instance in instances[ix]], axis=0))
+        return categories, targets
+    
+
 
 
 class customCOCOeval(COCOeval):
+    """COCOeval with vectorized bbox/segm evaluation. Detections are sorted 
+    once per image and category and the greedy matching handles all IoU 
+    thresholds at once. accumulate() fills the full [T,R,K,A,M] precision
+    array so every class can be summarized from a single evaluation.
+    Keypoints and useCats=0 fall back to COCOeval.
+    """
+    
+    def evaluate(self):
+        '''
+        Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        '''
+        p = self.params
+        # add backward compatibility if useSegm is specified in params
+        if not p.useSegm is None:
+            p.iouType = 'segm' if p.useSegm == 1 else 'bbox'
+        if p.iouType == 'keypoints' or not p.useCats:
+            return super(customCOCOeval, self).evaluate()
+        tic = time.time()
+        print('Running per image evaluation...')
+        print('Evaluate annotation type *{}*'.format(p.iouType))
+        p.imgIds = list(np.unique(p.imgIds))
+        p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+        self._prepare()
+        
+        maxDet = p.maxDets[-1]
+        I, A = len(p.imgIds), len(p.areaRng)
+        self.ious = {}
+        self.evalImgs = [None] * (len(p.catIds) * A * I)
+        for i, imgId in enumerate(p.imgIds):
+            # Detections sorted by score per category, as in computeIoU
+            gts = [self._gts[imgId, catId] for catId in p.catIds]
+            dts = []
+            for catId in p.catIds:
+                dt = self._dts[imgId, catId]
+                inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
+                dts.append([dt[j] for j in inds[:maxDet]])
+            for k, (catId, gt, dt) in enumerate(zip(p.catIds, gts, dts)):
+                if not gt and not dt:
+                    continue
+                self.ious[imgId, catId] = self.computeImageIoU(gt, dt)
+                for a, aRng in enumerate(p.areaRng):
+                    self.evalImgs[k * A * I + a * I + i] = self.evaluateSortedImg(
+                        imgId, catId, gt, dt, self.ious[imgId, catId], aRng, maxDet)
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+        
+    def computeImageIoU(self, gt, dt):
+        """Returns the [len(dt), len(gt)] IoU matrix of the detections and
+        ground truth of one image and category, in the given order."""
+        if len(gt) == 0 or len(dt) == 0:
+            return np.zeros((len(dt), len(gt)))
+        if self.params.iouType == 'segm':
+            g = [o['segmentation'] for o in gt]
+            d = [o['segmentation'] for o in dt]
+        else:
+            g = [o['bbox'] for o in gt]
+            d = [o['bbox'] for o in dt]
+        iscrowd = [int(o['iscrowd']) for o in gt]
+        return np.asarray(maskUtils.iou(d, g, iscrowd)).reshape([len(dt), len(gt)])
+    
+    def evaluateSortedImg(self, imgId, catId, gt, dt, ious, aRng, maxDet):
+        """Same as evaluateImg, but for detections already sorted by score
+        and matched for all IoU thresholds at once.
+        ious: [len(dt), len(gt)] IoUs of dt and gt in the given order
+        """
+        p = self.params
+        if len(gt) == 0 and len(dt) == 0:
+            return None
+        gtIg = np.array([g['ignore'] or g['area'] < aRng[0] or g['area'] > aRng[1] 
+                         for g in gt], dtype=np.bool).reshape([-1])
+        # Sort ground truth so that ignored ones come last
+        gtind = np.argsort(gtIg, kind='mergesort')
+        gtIg = gtIg[gtind]
+        gtIds = np.array([gt[j]['id'] for j in gtind])
+        iscrowd = np.array([bool(gt[j]['iscrowd']) for j in gtind], dtype=np.bool).reshape([-1])
+        dt = dt[:maxDet]
+        
+        T, G, D = len(p.iouThrs), len(gt), len(dt)
+        gtm = np.zeros((T, G))
+        dtm = np.zeros((T, D))
+        dtIg = np.zeros((T, D), dtype=np.bool)
+        if G and D:
+            ious = ious[:D, gtind]
+            thrs = np.minimum(p.iouThrs, 1 - 1e-10)[:, None]
+            # Match to the best non-ignored gt if possible, ties go to the
+            # last gt as in COCOeval.evaluateImg
+            priority = 2.0 * np.logical_not(gtIg)
+            rows = np.arange(T)
+            for d in range(D):
+                valid = (ious[d] >= thrs) & ((gtm == 0) | iscrowd)
+                key = np.where(valid, ious[d] + priority, -1)
+                m = G - 1 - np.argmax(key[:, ::-1], axis=1)
+                matched = valid[rows, m]
+                t, m = rows[matched], m[matched]
+                dtIg[t, d] = gtIg[m]
+                dtm[t, d] = gtIds[m]
+                gtm[t, m] = dt[d]['id']
+        # set unmatched detections outside of area range to ignore
+        a = np.array([d['area'] < aRng[0] or d['area'] > aRng[1] for d in dt]).reshape((1, D))
+        dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(a, T, 0)))
+        return {
+                'image_id':     imgId,
+                'category_id':  catId,
+                'aRng':         aRng,
+                'maxDet':       maxDet,
+                'dtIds':        [d['id'] for d in dt],
+                'gtIds':        list(gtIds),
+                'dtMatches':    dtm,
+                'gtMatches':    gtm,
+                'dtScores':     [d['score'] for d in dt],
+                'gtIgnore':     gtIg.astype(np.int32),
+                'dtIgnore':     dtIg,
+            }
+    
+    def accumulate(self, p=None):
+        '''
+        Accumulate per image evaluation results and store the result in self.eval
+        Same as COCOeval.accumulate, with the precision envelope and recall
+        thresholds computed for all IoU thresholds at once.
+        :param p: input params for evaluation
+        '''
+        print('Accumulating evaluation results...')
+        tic = time.time()
+        if not self.evalImgs:
+            print('Please run evaluate() first')
+        if p is None:
+            p = self.params
+        p.catIds = p.catIds if p.useCats == 1 else [-1]
+        T = len(p.iouThrs)
+        R = len(p.recThrs)
+        K = len(p.catIds) if p.useCats else 1
+        A = len(p.areaRng)
+        M = len(p.maxDets)
+        precision = -np.ones((T,R,K,A,M))
+        recall = -np.ones((T,K,A,M))
+        scores = -np.ones((T,R,K,A,M))
+        
+        _pe = self._paramsEval
+        catIds = _pe.catIds if _pe.useCats else [-1]
+        setK = set(catIds)
+        setA = set(map(tuple, _pe.areaRng))
+        setM = set(_pe.maxDets)
+        setI = set(_pe.imgIds)
+        k_list = [n for n, k in enumerate(p.catIds) if k in setK]
+        m_list = [m for n, m in enumerate(p.maxDets) if m in setM]
+        a_list = [n for n, a in enumerate(map(lambda x: tuple(x), p.areaRng)) if a in setA]
+        i_list = [n for n, i in enumerate(p.imgIds) if i in setI]
+        I0 = len(_pe.imgIds)
+        A0 = len(_pe.areaRng)
+        for k, k0 in enumerate(k_list):
+            Nk = k0*A0*I0
+            for a, a0 in enumerate(a_list):
+                Na = a0*I0
+                E = [self.evalImgs[Nk + Na + i] for i in i_list]
+                E = [e for e in E if not e is None]
+                if len(E) == 0:
+                    continue
+                gtIg = np.concatenate([e['gtIgnore'] for e in E])
+                npig = np.count_nonzero(gtIg==0)
+                if npig == 0:
+                    continue
+                # Concatenate and sort once for all maxDets. A stable sort 
+                # of all detections keeps the order of any subset.
+                dtScores = np.concatenate([e['dtScores'] for e in E])
+                dtRanks = np.concatenate([np.arange(len(e['dtScores'])) for e in E])
+                inds = np.argsort(-dtScores, kind='mergesort')
+                dtScores = dtScores[inds]
+                dtRanks = dtRanks[inds]
+                dtm = np.concatenate([e['dtMatches'] for e in E], axis=1)[:,inds]
+                dtIg = np.concatenate([e['dtIgnore'] for e in E], axis=1)[:,inds]
+                
+                for m, maxDet in enumerate(m_list):
+                    keep = dtRanks < maxDet
+                    dtScoresSorted = dtScores[keep]
+                    tps = np.logical_and(dtm[:,keep], np.logical_not(dtIg[:,keep]))
+                    fps = np.logical_and(np.logical_not(dtm[:,keep]), np.logical_not(dtIg[:,keep]))
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    nd = tp_sum.shape[1]
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+                    recall[:,k,a,m] = rc[:,-1] if nd else 0
+                    # Precision envelope: running maximum from the right
+                    pr = np.maximum.accumulate(pr[:,::-1], axis=1)[:,::-1]
+                    for t in range(T):
+                        q = np.zeros((R,))
+                        ss = np.zeros((R,))
+                        pinds = np.searchsorted(rc[t], p.recThrs, side='left')
+                        # Recall thresholds that are never reached stay 0
+                        valid = pinds < nd
+                        q[valid] = pr[t, pinds[valid]]
+                        ss[valid] = dtScoresSorted[pinds[valid]]
+                        precision[t,:,k,a,m] = q
+                        scores[t,:,k,a,m] = ss
+        self.eval = {
+            'params': p,
+            'counts': [T, R, K, A, M],
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'precision': precision,
+            'recall':   recall,
+            'scores': scores,
+        }
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format( toc-tic))
+        
+    def summarize_classes(self, verbose=0):
+        """Summarizes every class from the accumulated precision array.
+        Returns [K, 12] stats (or [K, 10] for keypoints), one row per
+        entry of params.catIds. self.stats is left at the summary of all
+        classes.
+        """
+        if not self.eval:
+            raise Exception('Please run accumulate() first')
+        stats = getattr(self, 'stats', None)
+        class_stats = []
+        for class_index in range(len(self.params.catIds)):
+            self.summarize(class_index=class_index, verbose=verbose)
+            class_stats.append(self.stats)
+        self.stats = stats
+        return np.stack(class_stats, axis=0)
     
     def summarize(self, class_index=None, verbose=1):
         '''
@@ -451,6 +2057,70 @@ class customCOCOeval(COCOeval):
     def __str__(self, cass_index=None):
         self.summarize(class_index)
 
+### Detection Results ###
+
+class CocoResultWriter(object):
+    """Streams detections in COCO result format to a JSON-lines file, one 
+    result per line, instead of keeping them all in memory while detecting.
+    All masks of one call are RLE encoded with a single maskUtils.encode call.
+    load() reads all results back for loadRes.
+    
+    Use add() for the detections of every image, then close() and load().
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+        self.count = 0
+        
+    def add(self, dataset, image_id, rois, class_ids, scores, masks):
+        """Appends the detections of one image.
+        image_id: Source (COCO) image id
+        rois: [N, (y1, x1, y2, x2)]
+        class_ids, scores: [N]
+        masks: [H, W, N], CropMasks or None to skip segmentations
+        """
+        if rois is None or rois.shape[0] == 0:
+            return
+        segmentations = [None] * rois.shape[0]
+        if isinstance(masks, CropMasks):
+            segmentations = masks.encode()
+        elif masks is not None:
+            # Encode all masks in one call
+            segmentations = maskUtils.encode(np.asfortranarray(masks.astype(np.uint8)))
+        bboxes = np.around(rois, 1).astype(np.float64)
+        for i in range(rois.shape[0]):
+            bbox = bboxes[i]
+            result = {
+                "image_id": int(image_id),
+                "category_id": int(dataset.get_source_class_id(int(class_ids[i]), "coco")),
+                "bbox": [bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]],
+                "score": float(scores[i]),
+            }
+            if segmentations[i] is not None:
+                result["segmentation"] = {"size": [int(x) for x in segmentations[i]["size"]],
+                                          "counts": segmentations[i]["counts"].decode("ascii")}
+            self.file.write(json.dumps(result) + "\n")
+            self.count += 1
+        
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            
+    def __len__(self):
+        return self.count
+            
+    def load(self):
+        """Reads all results back as a list of dicts for COCO.loadRes."""
+        self.close()
+        return self.read(self.path)
+    
+    @staticmethod
+    def read(path):
+        """Reads the results of a JSON-lines file as a list of dicts."""
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f]
+
 def evaluate_coco(model, dataset, coco_object, eval_type="bbox", 
                   limit=0, image_ids=None, class_index=None, verbose=1, return_results=False):
     """Wrapper to keep original function name usable"""
@@ -463,14 +2133,24 @@ def evaluate_coco(model, dataset, coco_object, eval_type="bbox",
     
         
 def evaluate_dataset(model, dataset, dataset_object, eval_type="bbox", dataset_type='coco', 
-                     limit=0, image_ids=None, class_index=None, verbose=1, random_detections=False, return_results=False):
+                     limit=0, image_ids=None, class_index=None, verbose=1, random_detections=False, return_results=False,
+                     results_path=None, episodes=None):
     """Runs official COCO evaluation.
     dataset: A Dataset object with valiadtion data
     eval_type: "bbox" or "segm" for bounding box or segmentation evaluation
     limit: if not 0, it's the number of images to use for evaluation
+    results_path: Optional. JSON-lines file to stream the detections to (see
+        CocoResultWriter). Defaults to a temporary file that is removed again.
+    episodes: Optional. EpisodeTable with fixed targets. By default targets
+        are drawn at random on every run.
+    Memory stays bounded during detection only. The evaluation loads all
+    encoded results and keeps the matches of every image, as COCOeval does.
     """
     assert dataset_type in ['coco']
+    check_eval_type(model.config, eval_type)
     # Pick COCO images from the dataset
+    if episodes is not None:
+        image_ids = image_ids or episodes.dataset_image_ids(dataset)
     image_ids = image_ids or dataset.image_ids
 
     # Limit to a subset
@@ -480,83 +2160,181 @@ def evaluate_dataset(model, dataset, dataset_object, eval_type="bbox", dataset_t
     # Get corresponding COCO image IDs.
     dataset_image_ids = [dataset.image_info[id]["id"] for id in image_ids]
 
-    t_prediction = 0
     t_start = time.time()
 
-    results = []
+    # Stream results to disk while detecting, so no detections or masks
+    # pile up in memory during detection. loadRes and the evaluation still
+    # hold all encoded results at once.
+    remove_results = results_path is None
+    if remove_results:
+        handle, results_path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+    results = CocoResultWriter(results_path)
+    try:
+        t_prediction, failed = detect_dataset_images(model, dataset, image_ids, results, 
+                                                     random_detections=random_detections, verbose=verbose,
+                                                     episodes=episodes)
+        
+        # Load results. This modifies results with additional attributes.
+        dataset_results = dataset_object.loadRes(results.load())
+    finally:
+        results.close()
+        if remove_results:
+            os.remove(results_path)
+    
+    cocoEval = run_coco_eval(dataset_object, dataset_results, dataset_image_ids, 
+                             eval_type=eval_type, class_index=class_index, verbose=verbose)
+    cocoEval.prediction_time = t_prediction
+    cocoEval.failed_detections = failed
+    if failed:
+        modellib.log("Detection failed for {} image categories, they count as missed".format(failed))
+    if verbose > 0:
+        print("Prediction time: {}. Average {}/image".format(
+            t_prediction, t_prediction / len(image_ids)))
+        print("Total time: ", time.time() - t_start)
+        
+    if return_results:
+        return cocoEval
+    
+    
+def detect_dataset_images(model, dataset, image_ids, results, random_detections=False, verbose=1,
+                          episodes=None):
+    """Draws targets for every active category of each image, runs detection
+    and adds the detections to a CocoResultWriter.
+    image_ids: Dataset image ids to detect on
+    results: CocoResultWriter or None to only run the detections
+    episodes: Optional. EpisodeTable to take the categories and targets from
+        instead of drawing them
+    Returns the time spent in detection and the number of target sets 
+    (image categories) detection failed for. These have no detections.
+    """
+    t_prediction = 0
+    failed = 0
     for i, image_id in enumerate(image_ids):
         if i%100 == 0 and verbose > 1:
             print("Processing image {}/{} ...".format(i, len(image_ids)))
         
-        # Load GT data
-        _, _, gt_class_ids, _, _ = modellib.load_image_gt(dataset, model.config, 
-                                                          image_id, augmentation=False, 
-                                                          use_mini_mask=model.config.USE_MINI_MASK)
-
-        # BOILERPLATE: Code duplicated in siamese_data_loader
-
-        # Skip images that have no instances. This can happen in cases
-        # where we train on a subset of classes and the image doesn't
-        # have any of the classes we care about.
-        if not np.any(gt_class_ids > 0):
-            continue
-
-        # Use only positive class_ids
-        categories = np.unique(gt_class_ids)
-        _idx = categories > 0
-        categories = categories[_idx]
-        # Use only active classes
-        active_categories = []
-        for c in categories:
-            if any(c == dataset.ACTIVE_CLASSES):
-                active_categories.append(c)
-
-        # Skiop image if it contains no instance of any active class    
-        if not np.any(np.array(active_categories) > 0):
+        if episodes is not None:
+            detection_categories, targets = episodes.load_targets(dataset, model.config, image_id)
+        else:
+            detection_categories, targets = draw_image_targets(dataset, model.config, image_id)
+        if not targets:
             continue
-
-        # END BOILERPLATE
-
-        # Evaluate for every category individually
-        for category in active_categories:
+        
+        # Load image
+        image = dataset.load_image(image_id)
             
-            # Load image
-            image = dataset.load_image(image_id)
-
-            # Draw random target
-            target = []
-            for k in range(model.config.NUM_TARGETS):
+        # Run detection for all categories on one image pyramid
+        t = time.time()
+        try:
+            category_results = model.detect_multi_target(targets, image, verbose=0, 
+                                                         random_detections=random_detections)
+        except KeyboardInterrupt:
+            raise
+        except:
+            modellib.logging.exception("Error running detection for image {}, retrying per category".format(
+                dataset.image_info[image_id]["id"]))
+            # Fall back to one category at a time so one failure only drops its category
+            detected_categories, category_results = [], []
+            for category, target in zip(detection_categories, targets):
                 try:
-                    target.append(get_one_target(category, dataset, model.config))
+                    category_results.extend(model.detect_multi_target([target], image, verbose=0,
+                                                                      random_detections=random_detections))
+                    detected_categories.append(category)
+                except KeyboardInterrupt:
+                    raise
                 except:
-                    print('error fetching target of category', category)
-                    continue
-            target = np.stack(target, axis=0)
-            # Run detection
-            t = time.time()
+                    modellib.logging.exception("Error running detection for image {}, category {}".format(
+                        dataset.image_info[image_id]["id"], category))
+                    failed += 1
+            detection_categories = detected_categories
+        t_prediction += (time.time() - t)
+
+        if results is None or not category_results:
+            continue
+        # Format detections
+        for category, r in zip(detection_categories, category_results):
+            r["class_ids"] = np.array([category for i in range(r["class_ids"].shape[0])])
+
+        # Convert results of all categories to COCO format at once
+        results.add(dataset, dataset.image_info[image_id]["id"],
+                    np.concatenate([r["rois"] for r in category_results]).reshape([-1, 4]),
+                    np.concatenate([r["class_ids"] for r in category_results]),
+                    np.concatenate([r["scores"] for r in category_results]),
+                    concatenate_result_masks([r["masks"] for r in category_results]))
+    return t_prediction, failed
+
+def concatenate_result_masks(masks_list):
+    """Concatenates the masks of several detection results, see 
+    CropMasks.concatenate. Returns None if any result has no masks (e.g. a
+    box-only FrozenSiameseMaskRCNN)."""
+    if any(masks is None for masks in masks_list):
+        return None
+    return CropMasks.concatenate(masks_list)
+
+def check_eval_type(config, eval_type):
+    """Raises an exception for segm evaluation of models without masks."""
+    if eval_type == "segm" and getattr(config, "MODEL", "mrcnn") != "mrcnn":
+        raise Exception("segm evaluation needs masks, {} models only detect boxes".format(config.MODEL))
+    
+    
+def draw_image_targets(dataset, config, image_id):
+    """Draws NUM_TARGETS random targets for every active category in an image.
+    Returns a list of category ids and a list of [K, h, w, 3] targets.
+    """
+    # Load GT class ids. Indexed datasets read them from the annotations
+    # so the image is only decoded once for detection
+    if isinstance(dataset, IndexedCocoDataset):
+        gt_class_ids = dataset.image_classes(image_id)
+    else:
+        _, _, gt_class_ids, _, _ = load_image_gt(dataset, config, 
+                                                 image_id, augmentation=False, 
+                                                 use_mini_mask=config.USE_MINI_MASK)
+
+    # BOILERPLATE: Code duplicated in siamese_data_loader
+
+    # Skip images that have no instances. This can happen in cases
+    # where we train on a subset of classes and the image doesn't
+    # have any of the classes we care about.
+    if not np.any(gt_class_ids > 0):
+        return [], []
+
+    # Use only positive class_ids
+    categories = np.unique(gt_class_ids)
+    _idx = categories > 0
+    categories = categories[_idx]
+    # Use only active classes
+    active_categories = []
+    for c in categories:
+        if any(c == dataset.ACTIVE_CLASSES):
+            active_categories.append(c)
+
+    # END BOILERPLATE
+
+    # Draw random targets for every category
+    detection_categories = []
+    targets = []
+    for category in active_categories:
+        target = []
+        for k in range(config.NUM_TARGETS):
             try:
-                r = model.detect([target], [image], verbose=0, random_detections=random_detections)[0]
+                target.append(get_one_target(category, dataset, config))
             except:
-                print('error running detection for category', category)
+                print('error fetching target of category', category)
                 continue
-            t_prediction += (time.time() - t)
-        
-            
-            # Format detections
-            r["class_ids"] = np.array([category for i in range(r["class_ids"].shape[0])])
-
-            # Convert results to COCO format
-            # Cast masks to uint8 because COCO tools errors out on bool
-            if dataset_type == 'coco':
-                image_results = coco.build_coco_results(dataset, dataset_image_ids[i:i + 1],
-                                                   r["rois"], r["class_ids"],
-                                                   r["scores"],
-                                                   r["masks"].astype(np.uint8))
-            results.extend(image_results)
+        if len(target) < config.NUM_TARGETS:
+            continue
+        detection_categories.append(category)
+        targets.append(np.stack(target, axis=0))
+    return detection_categories, targets
     
-    # Load results. This modifies results with additional attributes.
-    dataset_results = dataset_object.loadRes(results)
     
+def run_coco_eval(dataset_object, dataset_results, dataset_image_ids, eval_type="bbox", 
+                  class_index=None, verbose=1):
+    """Evaluates loaded results (dataset_object.loadRes) with customCOCOeval.
+    eval_type: "bbox", "segm" or a list of both
+    Returns the customCOCOeval of the last eval type.
+    """
     # allow evaluating bbox & segm:
     if not isinstance(eval_type, (list,)):
         eval_type = [eval_type]
@@ -568,15 +2346,184 @@ def evaluate_dataset(model, dataset, dataset_object, eval_type="bbox", dataset_t
         cocoEval.evaluate()
         cocoEval.accumulate()
         cocoEval.summarize(class_index=class_index, verbose=verbose)
-        if verbose > 0:
-            print("Prediction time: {}. Average {}/image".format(
-                t_prediction, t_prediction / len(image_ids)))
-            print("Total time: ", time.time() - t_start)
+    return cocoEval
+    
+    
+_shard_worker = {}
+
+def _init_shard_worker(dataset, config_values, model_dir, weights_path, threads, episodes):
+    # Imported here, lib.model imports this module
+    from lib import config as siamese_config
+    from lib import model as siamese_model
+    # Let every worker use only its share of the cores
+    keras.backend.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)))
+    # Rebuild the config from its values, its class may live in a notebook
+    config = siamese_config.Config.__new__(siamese_config.Config)
+    config.__dict__.update(config_values)
+    model = siamese_model.SiameseMaskRCNN(mode="inference", model_dir=model_dir, config=config)
+    model.load_weights(weights_path, by_name=True)
+    _shard_worker['model'] = model
+    _shard_worker['dataset'] = dataset
+    _shard_worker['episodes'] = episodes
+    
+def _evaluate_shard(shard):
+    image_ids, path, seed, random_detections = shard
+    # Same targets for a shard no matter which worker runs it or when
+    random.seed(seed)
+    np.random.seed(seed)
+    results = CocoResultWriter(path + '.tmp')
+    try:
+        t_prediction, failed = detect_dataset_images(_shard_worker['model'], _shard_worker['dataset'], 
+                                                     image_ids, results, random_detections=random_detections, 
+                                                     verbose=0, episodes=_shard_worker['episodes'])
+    finally:
+        results.close()
+    # A shard only counts as done once its file is complete
+    os.replace(path + '.tmp', path)
+    return path, t_prediction, failed
+    
+def evaluate_dataset_sharded(config, weights_path, model_dir, dataset, dataset_object, shard_dir,
+                             eval_type="bbox", limit=0, image_ids=None, class_index=None, verbose=1, 
+                             random_detections=False, return_results=False, shard_size=100, 
+                             workers=None, threads=None, seed=0, episodes=None):
+    """Runs evaluate_dataset in parallel on CPU worker processes. The images
+    are split into shards of shard_size images. Each worker builds its own
+    inference model and checkpoints the results of every shard it finishes
+    to shard_dir. Calling it again with the same arguments resumes and only 
+    runs the missing shards. Finally all shards are merged and evaluated.
+    
+    Shards are named by their image range, so use a new shard_dir when the
+    weights, config or image list change.
+    config: Inference config for the worker models
+    weights_path: Weights for the worker models
+    model_dir: Model directory for the worker models
+    shard_dir: Directory for the per shard JSON-lines results
+    workers: Number of worker processes. Defaults to one per 4 cores.
+    threads: TensorFlow threads per worker. Defaults to cores / workers.
+    seed: Base seed for drawing targets, shard i uses seed + i
+    episodes: Optional. EpisodeTable with fixed targets instead of seeded draws
+    """
+    check_eval_type(config, eval_type)
+    if episodes is not None:
+        image_ids = image_ids or episodes.dataset_image_ids(dataset)
+    image_ids = image_ids or dataset.image_ids
+    if limit:
+        image_ids = image_ids[:limit]
+    dataset_image_ids = [dataset.image_info[id]["id"] for id in image_ids]
+    cpus = multiprocessing.cpu_count()
+    workers = workers or max(1, cpus // 4)
+    threads = threads or max(1, cpus // workers)
+    
+    t_start = time.time()
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    shards = []
+    pending = []
+    for i, start in enumerate(range(0, len(image_ids), shard_size)):
+        end = min(start + shard_size, len(image_ids))
+        path = os.path.join(shard_dir, 'shard_{:06d}_{:06d}.jsonl'.format(start, end))
+        shards.append(path)
+        if not os.path.exists(path):
+            pending.append((image_ids[start:end], path, seed + i, random_detections))
+    if verbose > 0:
+        print("{} of {} shards done, running {} on {} workers".format(
+            len(shards) - len(pending), len(shards), len(pending), workers))
+    
+    t_prediction = 0
+    failed = 0
+    if pending:
+        config_values = {a: getattr(config, a) for a in dir(config) if a.isupper()}
+        # Spawn fresh processes, TensorFlow does not survive a fork. The 
+        # dataset is pickled into every worker, an attached TargetCropStore 
+        # only by its path, so workers map the crops instead of copying them
+        pool = multiprocessing.get_context('spawn').Pool(
+            min(workers, len(pending)), initializer=_init_shard_worker,
+            initargs=(dataset, config_values, model_dir, weights_path, threads, episodes))
+        try:
+            for n, (path, t, f) in enumerate(pool.imap_unordered(_evaluate_shard, pending)):
+                t_prediction += t
+                failed += f
+                if verbose > 1:
+                    print("Finished shard {}/{}: {}".format(n + 1, len(pending), path))
+        finally:
+            pool.terminate()
+            pool.join()
+    
+    # Merge all shards
+    results = []
+    for path in shards:
+        results.extend(CocoResultWriter.read(path))
+    dataset_results = dataset_object.loadRes(results)
+    cocoEval = run_coco_eval(dataset_object, dataset_results, dataset_image_ids, 
+                             eval_type=eval_type, class_index=class_index, verbose=verbose)
+    cocoEval.prediction_time = t_prediction
+    # Only known for the shards run by this call
+    cocoEval.failed_detections = failed
+    if failed:
+        modellib.log("Detection failed for {} image categories, they count as missed".format(failed))
+    if verbose > 0:
+        print("Prediction time: {} (summed over workers). Average {}/image".format(
+            t_prediction, t_prediction / len(image_ids)))
+        print("Total time: ", time.time() - t_start)
         
     if return_results:
         return cocoEval
     
     
+def quantization_report(config, export_dir, dataset, dataset_object, episodes, report_dir,
+                        modes=("weights8",), eval_type="segm", threads=0, verbose=1):
+    """Evaluates an exported float32 inference graph (see
+    SiameseMaskRCNN.export_inference_graph) and its quantized variants (see
+    lib.serving.quantize_inference_graph) on the same episodes, to choose the
+    accuracy / latency operating point for CPU inference.
+    export_dir: Directory of the float32 export
+    episodes: EpisodeTable to evaluate on
+    report_dir: Directory for the quantized graphs and report.json
+    modes: Quantization modes to compare with float32
+    threads: Optional. CPU threads of every session, 0 for all cores
+    Returns a list of dicts with the variant, graph size in MB, mAP, mAP50,
+    the detection time per image in seconds and the number of image
+    categories whose detection failed.
+    """
+    # Imported here, lib.serving is independent of this module
+    from lib import serving
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                    inter_op_parallelism_threads=threads)
+    variants = [("float32", export_dir)]
+    for mode in modes:
+        quantized_dir = os.path.join(report_dir, mode)
+        serving.quantize_inference_graph(export_dir, quantized_dir, mode=mode)
+        variants.append((mode, quantized_dir))
+
+    num_images = len(episodes.dataset_image_ids(dataset))
+    report = []
+    for name, path in variants:
+        model = serving.FrozenSiameseMaskRCNN(path, config=config, session_config=session_config)
+        try:
+            cocoEval = evaluate_dataset(model, dataset, dataset_object, eval_type=eval_type,
+                                        verbose=verbose - 1, return_results=True, episodes=episodes)
+        finally:
+            model.close()
+        report.append({"variant": name,
+                       "graph_mb": os.path.getsize(os.path.join(path, serving.GRAPH_FILENAME)) / 2**20,
+                       "mAP": float(cocoEval.stats[0]),
+                       "mAP50": float(cocoEval.stats[1]),
+                       "seconds_per_image": cocoEval.prediction_time / num_images,
+                       "failed_detections": int(cocoEval.failed_detections)})
+        if verbose > 0:
+            print("{variant:>8}: {graph_mb:7.1f} MB, mAP {mAP:.3f}, mAP50 {mAP50:.3f}, "
+                  "{seconds_per_image:.3f} s/image, {failed_detections} failed".format(**report[-1]))
+
+    os.makedirs(report_dir, exist_ok=True)
+    report_path = os.path.join(report_dir, "report.json")
+    with open(report_path + '.tmp', 'w') as f:
+        json.dump({"eval_type": eval_type, "episodes": len(episodes), "seed": None if episodes.seed is None else int(episodes.seed),
+                   "variants": report}, f, indent=1)
+    os.replace(report_path + '.tmp', report_path)
+    return report
+
+    
 ### Visualization ###
 
 def display_results(target, image, boxes, masks, class_ids,
@@ -586,7 +2533,7 @@ def display_results(target, image, boxes, masks, class_ids,
                       colors=None, captions=None):
     """
     boxes: [num_instance, (y1, x1, y2, x2, class_id)] in image coordinates.
-    masks: [height, width, num_instances]
+    masks: [height, width, num_instances] or None to show boxes only
     class_ids: [num_instances]
     class_names: list of class names of the dataset
     scores: (optional) confidence scores for each box
@@ -596,12 +2543,16 @@ def display_results(target, image, boxes, masks, class_ids,
     colors: (optional) An array or colors to use with each object
     captions: (optional) A list of strings to use as captions for each object
     """
+    # Materialize full masks once (see CropMasks)
+    if masks is not None:
+        masks = np.asarray(masks)
     # Number of instances
     N = boxes.shape[0]
     if not N:
         print("\n*** No instances to display *** \n")
     else:
-        assert boxes.shape[0] == masks.shape[-1] == class_ids.shape[0]
+        assert boxes.shape[0] == class_ids.shape[0]
+        assert masks is None or masks.shape[-1] == N
 
     # If no axis is passed, create one and automatically call show()
     auto_show = False
@@ -657,6 +2608,8 @@ def display_results(target, image, boxes, masks, class_ids,
                 color='w', size=11, backgroundcolor="none")
 
         # Mask
+        if masks is None:
+            continue
         mask = masks[:, :, i]
         if show_mask:
             masked_image = visualize.apply_mask(masked_image, mask, color)
@@ -735,7 +2688,7 @@ def display_grid(target_list, image_list, boxes_list, masks_list, class_ids_list
             target = target_list[index]
             image = image_list[index]
             boxes = boxes_list[index]
-            masks = masks_list[index]
+            masks = np.asarray(masks_list[index])
             class_ids = class_ids_list[index]
             scores = scores_list[index]
 
@@ -0,0 +1,267 @@
+# Parity tests of the refactored hot paths in lib.utils against the code
+# they replace, on small synthetic inputs.
+# Run from the repository root: python -m pytest tests
+
+import os
+import sys
+import copy
+import json
+import contextlib
+import io
+import numpy as np
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MASK_RCNN_MODEL_PATH = os.path.join(ROOT_DIR, 'lib', 'Mask_RCNN')
+
+if MASK_RCNN_MODEL_PATH not in sys.path:
+    sys.path.append(MASK_RCNN_MODEL_PATH)
+if ROOT_DIR not in sys.path:
+    sys.path.append(ROOT_DIR)
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+
+import skimage.io
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+from pycocotools import mask as maskUtils
+
+from mrcnn import utils
+from mrcnn import model as modellib
+from lib import utils as siamese_utils
+from lib import config as siamese_config
+
+
+class SmallConfig(siamese_config.Config):
+    NAME = 'test'
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 1 + 1
+    IMAGE_MIN_DIM = 128
+    IMAGE_MAX_DIM = 128
+    TARGET_MIN_DIM = 48
+    TARGET_MAX_DIM = 64
+    RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+
+
+CATEGORIES = [1, 2, 3, 5]
+
+
+def quiet():
+    """pycocotools prints its progress."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def random_coco(random_state, num_images=40, height=120, width=160):
+    """Returns COCO ground truth and detections with boxes as masks."""
+    images, annotations, detections = [], [], []
+    def encode(y, x, h, w):
+        mask = np.zeros((height, width), dtype=np.uint8, order='F')
+        mask[max(y, 0):y + h, max(x, 0):x + w] = 1
+        rle = maskUtils.encode(mask)
+        rle['counts'] = rle['counts'].decode()
+        return rle
+    for image_id in range(1, num_images + 1):
+        images.append({'id': image_id, 'height': height, 'width': width, 'file_name': ''})
+        for _ in range(random_state.randint(0, 6)):
+            category = int(random_state.choice(CATEGORIES))
+            y, x = random_state.randint(0, height - 40), random_state.randint(0, width - 40)
+            h, w = random_state.randint(4, 40, 2)
+            annotations.append({'id': len(annotations) + 1, 'image_id': image_id, 'category_id': category,
+                                'iscrowd': int(random_state.rand() < 0.1), 'area': float(h * w),
+                                'bbox': [x, y, w, h], 'segmentation': encode(y, x, h, w)})
+            for _ in range(random_state.randint(0, 3)):
+                dy, dx = random_state.randint(-6, 7, 2)
+                if random_state.rand() > 0.7:
+                    category = int(random_state.choice(CATEGORIES))
+                detections.append({'image_id': image_id, 'category_id': category, 'bbox': [x + dx, y + dy, w, h],
+                                   'score': float(np.round(random_state.rand(), 2)),
+                                   'segmentation': encode(y + dy, x + dx, h, w)})
+    coco_object = COCO()
+    coco_object.dataset = {'images': images, 'annotations': annotations,
+                           'categories': [{'id': c, 'name': str(c)} for c in CATEGORIES]}
+    with quiet():
+        coco_object.createIndex()
+    return coco_object, detections
+
+
+### customCOCOeval ###
+
+@pytest.mark.parametrize("iou_type", ["bbox", "segm"])
+def test_custom_coco_eval_matches_pycocotools(iou_type):
+    coco_object, detections = random_coco(np.random.RandomState(0))
+    with quiet():
+        results = coco_object.loadRes(copy.deepcopy(detections))
+        reference = COCOeval(coco_object, results, iou_type)
+        evaluation = siamese_utils.customCOCOeval(coco_object, results, iou_type)
+        for e in [reference, evaluation]:
+            e.evaluate()
+            e.accumulate()
+            e.summarize()
+    assert np.allclose(reference.stats, evaluation.stats)
+    assert np.allclose(reference.eval['precision'], evaluation.eval['precision'])
+    for a, b in zip(reference.evalImgs, evaluation.evalImgs):
+        assert (a is None) == (b is None)
+        if a is not None:
+            assert a['dtIds'] == b['dtIds']
+            for key in ['dtMatches', 'gtMatches', 'dtIgnore']:
+                assert np.array_equal(a[key], b[key])
+    for key, ious in evaluation.ious.items():
+        assert np.allclose(np.asarray(reference.ious[key]).reshape(np.shape(ious)), ious)
+
+
+### Instance index ###
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    """IndexedCocoDataset of images with filled rectangles, one color per
+    category, so the annotated boxes match the masks."""
+    dataset_dir = str(tmp_path_factory.mktemp("coco"))
+    random_state = np.random.RandomState(0)
+    os.makedirs(os.path.join(dataset_dir, 'val2017'))
+    os.makedirs(os.path.join(dataset_dir, 'annotations'))
+    images, annotations = [], []
+    for i in range(12):
+        h, w = random_state.randint(100, 200, 2)
+        image = np.zeros((h, w, 3), dtype=np.uint8)
+        image_id = 100 + 3 * i
+        for _ in range(random_state.randint(1, 5)):
+            category = int(random_state.choice(CATEGORIES))
+            bh, bw = [int(x) for x in random_state.randint(10, 60, 2)]
+            y, x = int(random_state.randint(0, h - bh)), int(random_state.randint(0, w - bw))
+            image[y:y + bh, x:x + bw] = 40 * category
+            annotations.append({'id': len(annotations) + 1, 'image_id': image_id, 'category_id': category,
+                                'iscrowd': int(random_state.rand() < 0.1), 'area': float(bh * bw),
+                                'bbox': [x, y, bw, bh],
+                                'segmentation': [[x, y, x + bw, y, x + bw, y + bh, x, y + bh]]})
+        file_name = '{:012d}.png'.format(image_id)
+        skimage.io.imsave(os.path.join(dataset_dir, 'val2017', file_name), image)
+        images.append({'id': image_id, 'file_name': file_name, 'height': int(h), 'width': int(w)})
+    with open(os.path.join(dataset_dir, 'annotations', 'instances_val2017.json'), 'w') as f:
+        json.dump({'images': images, 'annotations': annotations,
+                   'categories': [{'id': c, 'name': str(c), 'supercategory': ''} for c in CATEGORIES]}, f)
+    dataset = siamese_utils.IndexedCocoDataset()
+    with quiet():
+        dataset.load_coco(dataset_dir, 'val', year='2017')
+    dataset.prepare()
+    dataset.build_indices()
+    return dataset
+
+
+def test_category_image_index_matches_annotations(dataset):
+    # The loop of the previous IndexedCocoDataset._build_category_image_index, without crowds
+    for category in range(1, dataset.num_classes):
+        expected = [i for i, info in enumerate(dataset.image_info)
+                    if any(dataset.map_source_class_id("coco.{}".format(a['category_id'])) == category
+                           and not a['iscrowd'] for a in info['annotations'])]
+        assert dataset.category_image_index[category].tolist() == expected
+        for i in expected:
+            assert category in dataset.image_category_index[i]
+
+
+def test_instance_index_matches_load_image_gt(dataset):
+    # The previous get_one_target drew images from category_image_index and
+    # cropped the boxes of load_image_gt, the index must hold the same instances
+    config = SmallConfig()
+    for image_id in dataset.image_ids:
+        image, image_meta, class_ids, boxes, _ = siamese_utils.load_image_gt(dataset, config, image_id)
+        meta = modellib.parse_image_meta(image_meta[np.newaxis])
+        window, scale = meta["window"][0], meta["scale"][0]
+        for category in range(1, dataset.num_classes):
+            instances = dataset.category_instance_index[category]
+            instances = instances[instances['image_id'] == image_id]
+            expected = boxes[class_ids == category]
+            assert instances.shape[0] == expected.shape[0]
+            resized = instances['bbox'] * scale + np.tile(window[:2], 2)
+            order = np.lexsort(resized.T[::-1])
+            expected = expected[np.lexsort(expected.T[::-1])]
+            assert np.allclose(resized[order], expected, atol=1)
+            for instance, box in zip(instances[order], expected):
+                target, _, _, _, _, original_size = siamese_utils.load_target_instance(dataset, config, instance)
+                assert target.shape == tuple(config.TARGET_SHAPE)
+                assert np.allclose(original_size[:2], box[2:] - box[:2], atol=1)
+
+
+def test_draw_target_instance_draws_images_uniformly(dataset):
+    config = SmallConfig()
+    category = max(range(1, dataset.num_classes), key=lambda c: dataset.category_image_index[c].shape[0])
+    random_state = np.random.RandomState(0)
+    draws = [siamese_utils.draw_target_instance(category, dataset, config, random_state=random_state)
+             for _ in range(4000)]
+    image_ids, counts = np.unique([instance['image_id'] for instance in draws], return_counts=True)
+    assert image_ids.tolist() == dataset.category_image_index[category].tolist()
+    assert np.allclose(counts / len(draws), 1. / image_ids.shape[0], atol=0.03)
+
+
+### CropMasks ###
+
+def random_crop_masks(random_state, image_shape=(120, 160), count=30):
+    y1 = random_state.randint(0, image_shape[0] - 20, count)
+    x1 = random_state.randint(0, image_shape[1] - 20, count)
+    y2 = np.minimum(y1 + random_state.randint(1, 80, count), image_shape[0])
+    x2 = np.minimum(x1 + random_state.randint(1, 80, count), image_shape[1])
+    boxes = np.stack([y1, x1, y2, x2], axis=1)
+    crops = [random_state.rand(b[2] - b[0], b[3] - b[1]) > 0.5 for b in boxes]
+    dense = np.zeros(tuple(image_shape) + (count,), dtype=bool)
+    for i, (crop, (y1, x1, y2, x2)) in enumerate(zip(crops, boxes)):
+        dense[y1:y2, x1:x2, i] = crop
+    return siamese_utils.CropMasks(boxes, crops, image_shape), dense
+
+
+def test_crop_masks_match_dense_masks():
+    masks, dense = random_crop_masks(np.random.RandomState(0))
+    assert masks.shape == dense.shape
+    assert np.array_equal(masks.full(), dense)
+    assert np.array_equal(np.asarray(masks), dense)
+    for key in [(Ellipsis, 3), (slice(None), slice(None), [4, 1, 4]), (slice(10, 100), slice(None), slice(2, 20, 3)),
+                (Ellipsis, np.arange(dense.shape[-1]) % 3 == 0), (5, 7, 3), 5, (5, slice(None), [1, 2]),
+                (slice(None), slice(None), slice(None, None, -2)), (Ellipsis, [])]:
+        assert np.array_equal(masks[key], dense[key])
+    for threshold in [0, 0.5, 1, True, False]:
+        assert np.array_equal(np.asarray(masks > threshold), dense > threshold)
+        assert np.array_equal(np.asarray(masks == threshold), dense == threshold)
+        assert np.array_equal(np.asarray(masks < threshold), dense < threshold)
+    more_masks, more_dense = random_crop_masks(np.random.RandomState(1), count=3)
+    both = siamese_utils.CropMasks.concatenate([masks, more_masks])
+    assert np.array_equal(both.full(), np.concatenate([dense, more_dense], axis=-1))
+
+
+def test_crop_masks_unmold_matches_unmold_mask():
+    random_state = np.random.RandomState(0)
+    image_shape = (120, 160, 3)
+    masks, _ = random_crop_masks(random_state, image_shape[:2])
+    probabilities = random_state.rand(masks.shape[-1], 28, 28).astype(np.float32)
+    unmolded = siamese_utils.CropMasks.unmold(probabilities, masks.boxes, image_shape)
+    expected = np.stack([utils.unmold_mask(p, b, image_shape) for p, b in zip(probabilities, masks.boxes)], axis=-1)
+    # Same bilinear resize as skimage, up to rounding at the threshold
+    assert unmolded.shape == expected.shape
+    assert np.mean(unmolded.full() != expected) < 1e-3
+
+
+### RPN targets ###
+
+def random_gt(random_state, image_shape, max_instances=10):
+    n = random_state.randint(1, max_instances)
+    h, w = image_shape[:2]
+    y1, x1 = random_state.randint(0, h - 16, n), random_state.randint(0, w - 16, n)
+    y2 = np.minimum(y1 + random_state.randint(4, 64, n), h)
+    x2 = np.minimum(x1 + random_state.randint(4, 64, n), w)
+    class_ids = np.where(random_state.rand(n) < 0.2, -1, 1).astype(np.int32)
+    class_ids[0] = 1
+    return class_ids, np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+
+
+def test_build_rpn_targets_matches_modellib():
+    config = SmallConfig()
+    anchors = siamese_utils.get_anchors(config, config.IMAGE_SHAPE)
+    geometry = siamese_utils.get_anchor_geometry(config)
+    random_state = np.random.RandomState(0)
+    for seed in range(50):
+        class_ids, boxes = random_gt(random_state, config.IMAGE_SHAPE)
+        np.random.seed(seed)
+        rpn_match, rpn_bbox = modellib.build_rpn_targets(config.IMAGE_SHAPE, anchors, class_ids, boxes, config)
+        np.random.seed(seed)
+        new_rpn_match, new_rpn_bbox = siamese_utils.build_rpn_targets(geometry, class_ids, boxes, config)
+        assert np.array_equal(rpn_match, new_rpn_match)
+        assert np.allclose(rpn_bbox, new_rpn_bbox, atol=1e-6)